@@ -11,6 +11,8 @@ load_dotenv()
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 import logging
+import logging.handlers
+import queue
 
 # Disable PyMongo debug logging
 logging.getLogger('pymongo').setLevel(logging.WARNING)
@@ -19,10 +21,31 @@ logging.getLogger('urllib3').setLevel(logging.WARNING)
 mongo = PyMongo()
 jwt = JWTManager()
 
+# Writes log records to stderr off the request/socket handlers; started once per process
+_log_listener = None
+
+def configure_logging():
+    """Configure the root logger once: handlers only enqueue, a listener thread does the I/O"""
+    global _log_listener
+    if _log_listener is not None:
+        return
+    
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(logging.DEBUG if os.environ.get('FLASK_ENV') == 'development' else logging.INFO)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    _log_listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    _log_listener.start()
+
 def create_app(test_config=None, with_socketio=True):
     # Load environment variables
     load_dotenv()
     
+    configure_logging()
+    
     # Create and configure the app
     app = Flask(__name__, instance_relative_config=True)
     
@@ -33,7 +56,12 @@ def create_app(test_config=None, with_socketio=True):
         JWT_SECRET_KEY=os.environ.get('JWT_SECRET_KEY', 'jwt_dev_key'),
         JWT_ACCESS_TOKEN_EXPIRES=86400,  # 24 hours
         UPLOAD_FOLDER=os.path.join(app.instance_path, 'uploads'),
-        FRONTEND=os.environ.get('FRONTEND', 'http://localhost:3000')
+        FRONTEND=os.environ.get('FRONTEND', 'http://localhost:3000'),
+        REDIS_URL=os.environ.get('REDIS_URL'),
+        SOCKETIO_ASYNC_MODE=os.environ.get('SOCKETIO_ASYNC_MODE', 'eventlet'),
+        SOCKETIO_SERIALIZER=os.environ.get('SOCKETIO_SERIALIZER', 'default'),
+        SOCKETIO_WEBSOCKET_DEFLATE=os.environ.get('SOCKETIO_WEBSOCKET_DEFLATE', 'true').lower() == 'true',
+        ANALYTICS_SCHEDULER_ENABLED=os.environ.get('ANALYTICS_SCHEDULER_ENABLED', 'true').lower() == 'true'
     )
     
     # Ensure the instance folder exists
@@ -49,6 +77,9 @@ def create_app(test_config=None, with_socketio=True):
     mongo.init_app(app)
     jwt.init_app(app)
     
+    from app.models.presence import init_presence_cache
+    init_presence_cache(app.config['REDIS_URL'])
+    
     frontend_origin = app.config['FRONTEND']
     print(f"CORS is configured for origin: {frontend_origin}")
 
@@ -96,47 +127,21 @@ def create_app(test_config=None, with_socketio=True):
     from app.api.ai_chat_routes import ai_chat_bp
     app.register_blueprint(ai_chat_bp, url_prefix='/api/chat/ai')
     
+    # Keep the materialized analytics views fresh in the background
+    if app.config['ANALYTICS_SCHEDULER_ENABLED'] and not app.testing:
+        from app.analytics.scheduler import init_scheduler
+        init_scheduler(app)
+    
     # Test route
     @app.route('/ping')
     def ping():
         return {"message": "pong", "status": "success"}
     
     # Initialize Socket.IO only after app is fully set up
-    socketio = None
     if with_socketio:
         try:
-            # Use a more specific exception handler to diagnose problems
-            from flask_socketio import SocketIO
-            
-            # Create SocketIO instance
-            socketio = SocketIO()
-            socketio.init_app(app, cors_allowed_origins=[
-                app.config['FRONTEND'], 
-                "http://localhost:3787"
-            ])
-            
-            # Store socketio instance in app for access from routes
-            app.socketio = socketio
-            
-            # Register all socket event handlers
-            from app.realtime.events import register_handlers as register_events
-            register_events(socketio)
-            
-            from app.realtime.presence import register_handlers as register_presence
-            register_presence(socketio)
-            
-            from app.realtime.typing import register_handlers as register_typing
-            register_typing(socketio)
-            
-            from app.realtime.chat import register_handlers as register_chat
-            register_chat(socketio)
-            
-            from app.realtime.group_chat import register_handlers as register_group_chat
-            register_group_chat(socketio)
-            
-            # Register calling handlers
-            from app.realtime.calling import register_handlers as register_calling
-            register_calling(socketio)
+            from app.realtime import init_socketio
+            init_socketio(app)
             
             print("SocketIO initialized successfully")
         except Exception as e:
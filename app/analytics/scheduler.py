@@ -0,0 +1,116 @@
+import datetime
+import logging
+from datetime import timezone
+from pymongo.errors import DuplicateKeyError
+from app import mongo
+
+logger = logging.getLogger(__name__)
+
+# Background scheduler shared by the process (None until init_scheduler runs)
+_scheduler = None
+
+# Refresh cadence per view, in minutes
+REFRESH_INTERVALS = {
+    "conversation_summary": 5,
+    "user_activity_summary": 5,
+    "group_analytics_summary": 60,
+    "file_usage_summary": 24 * 60
+}
+
+def acquire_refresh_lock(name, ttl_seconds):
+    """Try to take the refresh lock for a view so only one worker refreshes it.
+    
+    The lock document is upserted only if it does not exist or has expired;
+    if another worker holds it the upsert collides on _id and we back off.
+    """
+    now = datetime.datetime.now(timezone.utc)
+    try:
+        mongo.db.refresh_locks.find_one_and_update(
+            {"_id": name, "expires_at": {"$lte": now}},
+            {"$set": {
+                "locked_at": now,
+                "expires_at": now + datetime.timedelta(seconds=ttl_seconds)
+            }},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        return False
+
+def release_refresh_lock(name):
+    """Release the refresh lock for a view"""
+    mongo.db.refresh_locks.delete_one({"_id": name})
+
+def _run_refresh(app, name):
+    """Refresh one view under its lock"""
+    from app.models.views import DatabaseViews
+    
+    refreshers = {
+        "conversation_summary": DatabaseViews.refresh_conversation_summary_view,
+        "user_activity_summary": DatabaseViews.refresh_user_activity_view,
+        "group_analytics_summary": DatabaseViews.refresh_group_analytics_view,
+        "file_usage_summary": DatabaseViews.refresh_file_usage_view
+    }
+    
+    with app.app_context():
+        # Hold the lock for at most one interval so a crashed worker can't block refreshes
+        if not acquire_refresh_lock(name, REFRESH_INTERVALS[name] * 60):
+            return
+        try:
+            if refreshers[name]():
+                _notify_refreshed(name)
+        except Exception:
+            logger.exception("Error refreshing view %s", name)
+        finally:
+            release_refresh_lock(name)
+
+def _notify_refreshed(name):
+    """Tell connected dashboards that a view has fresh data"""
+    from app.realtime import socketio
+    
+    if socketio.server is None:
+        return
+    socketio.start_background_task(socketio.emit, 'analytics_view_refreshed', {'view_name': name})
+
+def init_scheduler(app):
+    """Start the background scheduler that keeps the analytics views fresh"""
+    global _scheduler
+    if _scheduler is not None:
+        return _scheduler
+    
+    try:
+        from apscheduler.schedulers.background import BackgroundScheduler
+    except ImportError:
+        logger.warning("APScheduler is not installed; analytics views will only refresh on demand")
+        return None
+    
+    scheduler = BackgroundScheduler(daemon=True)
+    for name, minutes in REFRESH_INTERVALS.items():
+        scheduler.add_job(
+            _run_refresh,
+            'interval',
+            minutes=minutes,
+            args=[app, name],
+            id=f"refresh_{name}",
+            max_instances=1,
+            coalesce=True
+        )
+    
+    scheduler.start()
+    _scheduler = scheduler
+    logger.info("Analytics view refresh scheduler started")
+    return scheduler
+
+def enqueue_refresh():
+    """Ask the scheduler to run every view refresh now.
+    
+    Returns False when no scheduler is running, in which case the caller
+    should refresh inline.
+    """
+    if _scheduler is None:
+        return False
+    
+    now = datetime.datetime.now(timezone.utc)
+    for job in _scheduler.get_jobs():
+        job.modify(next_run_time=now)
+    return True
@@ -145,13 +145,19 @@ def send_message(recipient_id):
             attachment=attachment
         )
         
+        # Converted once, shared by the response and the socket notification
+        message_id_str = str(message["_id"])
+        sender_str = str(message["sender_id"])
+        recipient_str = str(message["recipient_id"])
+        timestamp = message["created_at"].isoformat()
+        
         # Format the response
         formatted_message = {
-            "id": str(message["_id"]),
-            "sender": str(message["sender_id"]),
-            "recipient": str(message["recipient_id"]),
+            "id": message_id_str,
+            "sender": sender_str,
+            "recipient": recipient_str,
             "content": message["content"],
-            "timestamp": message["created_at"].isoformat(),
+            "timestamp": timestamp,
             "status": message["status"],
             "message_type": message.get("message_type", "text"),
             "attachment": message.get("attachment")
@@ -173,13 +179,13 @@ def send_message(recipient_id):
 
                 # Emit the message to the room
                 emit('receive_message', {
-                    'id': str(message['_id']),
-                    'sender': str(message['sender_id']),
+                    'id': message_id_str,
+                    'sender': sender_str,
                     'sender_name': sender.get('username', ''),
                     'sender_avatar': sender.get('profile_picture', ''),
-                    'recipient': str(message['recipient_id']),
+                    'recipient': recipient_str,
                     'content': message['content'],
-                    'timestamp': message['created_at'].isoformat(),
+                    'timestamp': timestamp,
                     'status': message['status'],
                     'message_type': message['message_type'],
                     # Format as an array for the frontend
@@ -190,7 +196,7 @@ def send_message(recipient_id):
             except Exception as e:
                 print(f"[API] Error emitting socket event: {str(e)}")
         
-        print(f"[API] Message sent successfully with ID: {str(message['_id'])}")
+        print(f"[API] Message sent successfully with ID: {message_id_str}")
         return jsonify({
             "success": True,
             "message": "Message sent successfully",
@@ -625,16 +625,22 @@ def get_view_data(view_name):
     """Get data from a specific analytics view"""
     try:
         limit = request.args.get('limit', 20, type=int)
-        skip = request.args.get('skip', 0, type=int)
+        after = request.args.get('after')
         
-        data = DatabaseViews.get_view_data(view_name, limit=limit, skip=skip)
+        data, next_cursor = DatabaseViews.get_view_page(view_name, limit=limit, after=after)
         
         return jsonify({
             "success": True,
             "view_name": view_name,
             "data": data,
-            "count": len(data)
+            "count": len(data),
+            "next_cursor": next_cursor
         })
+    except ValueError as e:
+        return jsonify({
+            "success": False,
+            "message": str(e)
+        }), 400
     except Exception as e:
         return jsonify({
             "success": False,
@@ -1,20 +1,22 @@
 import datetime
 from datetime import timezone
 from bson import ObjectId
+from pymongo import UpdateOne
 from app import mongo
 
 class Call:
     """Call model for VOIP calling functionality."""
     
     @staticmethod
-    def create_call_session(caller_id, callee_id, call_type="voice"):
-        """Create a new call session"""
+    def create_call_session(caller_id, callee_id, call_type="voice", status="initiated"):
+        """Create a new call session, optionally already in the ringing state"""
+        now = datetime.datetime.now(timezone.utc)
         call = {
             "caller_id": ObjectId(caller_id),
             "callee_id": ObjectId(callee_id),
             "call_type": call_type,  # "voice" or "video" (future)
-            "status": "initiated",   # initiated, ringing, answered, ended, missed, declined
-            "start_time": datetime.datetime.now(timezone.utc),
+            "status": status,        # initiated, ringing, answered, ended, missed, declined
+            "start_time": now,
             "answer_time": None,
             "end_time": None,
             "duration": None,  # in seconds
@@ -23,10 +25,13 @@ class Call:
                 "packet_loss": None,
                 "connection_quality": None
             },
-            "created_at": datetime.datetime.now(timezone.utc),
-            "updated_at": datetime.datetime.now(timezone.utc)
+            "created_at": now,
+            "updated_at": now
         }
         
+        if status == "ringing":
+            call["ring_time"] = now
+        
         result = mongo.db.calls.insert_one(call)
         call["_id"] = result.inserted_id
         return call
@@ -70,14 +75,24 @@ class Call:
         return result.modified_count > 0
     
     @staticmethod
-    def end_call(call_id, quality_metrics=None):
+    def mark_answered(call_id):
+        """Move a ringing call to answered; returns False if it was not ringing anymore"""
+        now = datetime.datetime.now(timezone.utc)
+        result = mongo.db.calls.update_one(
+            {"_id": ObjectId(call_id), "status": {"$in": ["initiated", "ringing"]}},
+            {"$set": {"status": "answered", "answer_time": now, "updated_at": now}}
+        )
+        return result.modified_count > 0
+    
+    @staticmethod
+    def end_call(call_id, quality_metrics=None, end_time=None):
         """End a call and calculate duration"""
         try:
             call = Call.get_by_id(call_id)
             if not call:
                 return False
             
-            end_time = datetime.datetime.now(timezone.utc)
+            end_time = end_time or datetime.datetime.now(timezone.utc)
             update_data = {
                 "status": "ended",
                 "end_time": end_time,
@@ -104,6 +119,44 @@ class Call:
             print(f"Error ending call {call_id}: {e}")
             return False
     
+    @staticmethod
+    def bulk_update_statuses(updates):
+        """Apply many (call_id, status, timestamp) status changes in one unordered bulk write"""
+        if not updates:
+            return 0
+        
+        # Only the latest change per call is written, so the unordered writes can't race
+        latest = {}
+        for call_id, status, timestamp in updates:
+            latest[call_id] = (status, timestamp)
+        
+        operations = []
+        for call_id, (status, timestamp) in latest.items():
+            update_data = {
+                "status": status,
+                "updated_at": timestamp
+            }
+            
+            if status == "ringing":
+                update_data["ring_time"] = timestamp
+            elif status == "answered":
+                update_data["answer_time"] = timestamp
+            elif status in ["ended", "missed", "declined"]:
+                update_data["end_time"] = timestamp
+                # Duration is derived from the stored answer_time in the same update
+                update_data["duration"] = {
+                    "$cond": [
+                        {"$ifNull": ["$answer_time", False]},
+                        {"$toInt": {"$divide": [{"$subtract": [timestamp, "$answer_time"]}, 1000]}},
+                        "$duration"
+                    ]
+                }
+            
+            operations.append(UpdateOne({"_id": ObjectId(call_id)}, [{"$set": update_data}]))
+        
+        result = mongo.db.calls.bulk_write(operations, ordered=False)
+        return result.modified_count
+    
     @staticmethod
     def get_user_call_history(user_id, limit=50, skip=0):
         """Get call history for a user"""
@@ -114,3 +114,54 @@ class File:
         except Exception as e:
             print(f"Error finding file by filename: {str(e)}")
             return None
+    
+    @staticmethod
+    def resolve_attachment(uploader_id, attachment_id=None, filename=None, type_hint=None):
+        """
+        Find the file or media document a chat attachment refers to in one aggregation
+        
+        Candidates are ranked the way the separate lookups used to run: by ID in the
+        collection the type hint points at, by ID in the other one, then the user's most
+        recent upload with that exact filename, then one whose filename contains it.
+        
+        Parameters:
+        - uploader_id: ID of the sending user (filename matches are limited to their uploads)
+        - attachment_id: Media/File document ID sent by the client, if any
+        - filename: Original filename sent by the client, if any
+        - type_hint: Attachment type sent by the client ('image', 'video', 'audio' are media)
+        
+        Returns:
+        - Matching document (with a "source" field naming its collection) or None
+        """
+        primary, other = ("media", "files") if type_hint in ("image", "video", "audio") else ("files", "media")
+        
+        def ranked(collection, match, rank, latest=False):
+            stages = [{"$match": dict(match, is_deleted=False)}]
+            if latest:
+                stages += [{"$sort": {"created_at": -1}}, {"$limit": 1}]
+            stages.append({"$addFields": {"source": collection, "_rank": rank}})
+            return stages
+        
+        candidates = []
+        if attachment_id and ObjectId.is_valid(attachment_id):
+            candidates.append((primary, ranked(primary, {"_id": ObjectId(attachment_id)}, 0)))
+            candidates.append((other, ranked(other, {"_id": ObjectId(attachment_id)}, 1)))
+        if filename and ObjectId.is_valid(uploader_id):
+            owner = {"uploader_id": ObjectId(uploader_id)}
+            pattern = re.compile(f".*{re.escape(filename)}.*", re.IGNORECASE)
+            candidates.append((primary, ranked(primary, dict(owner, original_filename=filename), 2, latest=True)))
+            candidates.append((primary, ranked(primary, dict(owner, original_filename={"$regex": pattern}), 3, latest=True)))
+        if not candidates:
+            return None
+        
+        (first_collection, pipeline), rest = candidates[0], candidates[1:]
+        pipeline = list(pipeline)
+        for collection, stages in rest:
+            pipeline.append({"$unionWith": {"coll": collection, "pipeline": stages}})
+        pipeline += [{"$sort": {"_rank": 1}}, {"$limit": 1}, {"$project": {"_rank": 0}}]
+        
+        try:
+            return next(mongo.db[first_collection].aggregate(pipeline), None)
+        except Exception as e:
+            print(f"Error resolving attachment: {str(e)}")
+            return None
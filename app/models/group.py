@@ -3,6 +3,14 @@ from datetime import timezone
 from bson import ObjectId
 from app import mongo
 import gridfs
+import time
+
+# Group documents read by socket handlers on every event: group_id -> (group, cached_until)
+_group_cache = {}
+
+# Members rarely change; other workers' caches converge within the TTL after an update
+GROUP_CACHE_TTL = 10
+GROUP_CACHE_SIZE = 2048
 
 class Group:
     """Group model for group chats."""
@@ -40,6 +48,31 @@ class Group:
         """Get group by ID"""
         return mongo.db.groups.find_one({"_id": ObjectId(group_id), "is_active": True})
     
+    @staticmethod
+    def get_cached(group_id):
+        """Get group by ID, cached for GROUP_CACHE_TTL seconds; the document is shared, don't modify it
+        
+        Cached documents also carry '_member_ids', the members as a set of strings, so
+        handlers can check a user id from a token without converting it to an ObjectId.
+        """
+        group_id = str(group_id)
+        cached = _group_cache.get(group_id)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        
+        group = Group.get_by_id(group_id)
+        if group:
+            group['_member_ids'] = {str(member_id) for member_id in group['members']}
+            if len(_group_cache) >= GROUP_CACHE_SIZE:
+                _group_cache.clear()
+            _group_cache[group_id] = (group, time.monotonic() + GROUP_CACHE_TTL)
+        return group
+    
+    @staticmethod
+    def forget_cached(group_id):
+        """Drop a cached group after its members or details change"""
+        _group_cache.pop(str(group_id), None)
+    
     @staticmethod
     def get_user_groups(user_id):
         """Get all groups a user is a member of"""
@@ -47,6 +80,13 @@ class Group:
             {"members": ObjectId(user_id), "is_active": True}
         ).sort("updated_at", -1))
     
+    @staticmethod
+    def get_user_group_ids(user_id):
+        """Get the IDs of all groups a user is a member of (socket room membership on connect)"""
+        return [group["_id"] for group in mongo.db.groups.find(
+            {"members": ObjectId(user_id), "is_active": True}, {"_id": 1}
+        )]
+    
     @staticmethod
     def add_member(group_id, user_id, admin_id, max_retries=3):
         """Add a member to the group (admin only) with optimistic locking"""
@@ -86,6 +126,7 @@ class Group:
                 )
                 
                 if result.modified_count > 0:
+                    Group.forget_cached(group_id)
                     return {"success": True, "message": "Member added successfully"}
                 
                 # If we reach here, there was a concurrent modification
@@ -93,7 +134,6 @@ class Group:
                     return {"success": False, "message": "Failed to add member due to concurrent modifications"}
                 
                 # Small delay before retry
-                import time
                 time.sleep(0.1)
             
             return {"success": False, "message": "Failed to add member after retries"}
@@ -147,6 +187,7 @@ class Group:
                 )
                 
                 if result.modified_count > 0:
+                    Group.forget_cached(group_id)
                     return {"success": True, "message": "Member removed successfully"}
                 
                 # If we reach here, there was a concurrent modification
@@ -154,7 +195,6 @@ class Group:
                     return {"success": False, "message": "Failed to remove member due to concurrent modifications"}
                 
                 # Small delay before retry
-                import time
                 time.sleep(0.1)
             
             return {"success": False, "message": "Failed to remove member after retries"}
@@ -203,6 +243,7 @@ class Group:
                 )
                 
                 if result.modified_count > 0:
+                    Group.forget_cached(group_id)
                     return {"success": True, "message": "User promoted to admin successfully"}
                 
                 # If we reach here, there was a concurrent modification
@@ -210,7 +251,6 @@ class Group:
                     return {"success": False, "message": "Failed to promote user due to concurrent modifications"}
                 
                 # Small delay before retry
-                import time
                 time.sleep(0.1)
             
             return {"success": False, "message": "Failed to promote user after retries"}
@@ -254,6 +294,7 @@ class Group:
                 )
                 
                 if result.modified_count > 0:
+                    Group.forget_cached(group_id)
                     return {"success": True, "message": "Group updated successfully"}
                 
                 # If we reach here, there was a concurrent modification
@@ -261,7 +302,6 @@ class Group:
                     return {"success": False, "message": "Failed to update group due to concurrent modifications"}
                 
                 # Small delay before retry
-                import time
                 time.sleep(0.1)
             
             return {"success": False, "message": "Failed to update group after retries"}
@@ -305,6 +345,7 @@ class Group:
                 )
                 
                 if result.modified_count > 0:
+                    Group.forget_cached(group_id)
                     return {"success": True, "message": "Group icon updated successfully"}
                 
                 # If we reach here, there was a concurrent modification
@@ -312,7 +353,6 @@ class Group:
                     return {"success": False, "message": "Failed to update icon due to concurrent modifications"}
                 
                 # Small delay before retry
-                import time
                 time.sleep(0.1)
             
             return {"success": False, "message": "Failed to update icon after retries"}
@@ -362,6 +402,7 @@ class Group:
                 )
                 
                 if result.modified_count > 0:
+                    Group.forget_cached(group_id)
                     return {"success": True, "message": "Group icon removed successfully"}
                 
                 # If we reach here, there was a concurrent modification
@@ -369,7 +410,6 @@ class Group:
                     return {"success": False, "message": "Failed to remove icon due to concurrent modifications"}
                 
                 # Small delay before retry
-                import time
                 time.sleep(0.1)
             
             return {"success": False, "message": "Failed to remove icon after retries"}
@@ -33,10 +33,16 @@ class GroupMessage:
         result = mongo.db.group_messages.insert_one(message)
         message["_id"] = result.inserted_id
         
-        # Update the group's updated_at timestamp
+        # Update the group's updated_at timestamp and its message counters
+        # (read directly by the group analytics view)
         mongo.db.groups.update_one(
             {"_id": ObjectId(group_id)},
-            {"$set": {"updated_at": datetime.datetime.now(timezone.utc)}}
+            {
+                "$set": {"updated_at": message["created_at"]},
+                "$inc": {"total_messages": 1},
+                "$max": {"last_message_time": message["created_at"]},
+                "$min": {"first_message_time": message["created_at"]}
+            }
         )
         
         return message
@@ -110,7 +116,7 @@ class GroupMessage:
             (group and ObjectId(user_id) in group.get("admins", []))):
             
             result = mongo.db.group_messages.update_one(
-                {"_id": ObjectId(message_id)},
+                {"_id": ObjectId(message_id), "is_deleted": False},
                 {
                     "$set": {
                         "is_deleted": True,
@@ -118,6 +124,14 @@ class GroupMessage:
                     }
                 }
             )
-            return result.modified_count > 0
+            
+            if result.modified_count > 0:
+                mongo.db.groups.update_one(
+                    {"_id": message["group_id"]},
+                    {"$inc": {"total_messages": -1}}
+                )
+                return True
+            
+            return False
         
         return False
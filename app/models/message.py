@@ -2,6 +2,7 @@ import datetime
 from datetime import timezone
 from bson import ObjectId
 from app import mongo
+from app.models.user import User
 
 class Message:
     """Message model for user-to-user communication."""
@@ -10,6 +11,39 @@ class Message:
     STATUS_DELIVERED = "delivered"
     STATUS_READ = "read"
     
+    @staticmethod
+    def build(sender_id, recipient_id, content, message_type="text", attachment=None,
+              message_id=None, created_at=None):
+        """Build a new message document, with its _id already assigned, without saving it
+        
+        message_id and created_at may be given when they were handed out before the build.
+        """
+        sender_oid = ObjectId(sender_id)
+        recipient_oid = ObjectId(recipient_id)
+        
+        # Denormalize participant names onto the message so the analytics
+        # views don't need to $lookup into users (from the cached sender profiles)
+        sender_username, sender_email = User.get_message_identity(sender_oid)
+        recipient_username, _ = User.get_message_identity(recipient_oid)
+        
+        now = created_at or datetime.datetime.now(timezone.utc)
+        return {
+            "_id": message_id or ObjectId(),
+            "sender_id": sender_oid,
+            "recipient_id": recipient_oid,
+            "sender_username": sender_username,
+            "sender_email": sender_email,
+            "recipient_username": recipient_username,
+            "content": content,
+            "message_type": message_type,
+            "attachment": attachment,
+            "created_at": now,
+            "updated_at": now,
+            "status": Message.STATUS_SENT,
+            "is_deleted": False,
+            "room_id" : f"{min(sender_id, recipient_id)}_{max(sender_id, recipient_id)}",  # Generate a consistent room ID for the message
+        }
+    
     @staticmethod
     def create(sender_id, recipient_id, content, message_type="text", attachment=None):
         """
@@ -28,23 +62,11 @@ class Message:
         print(f"[MESSAGE CREATE] Type: {message_type}, Attachment: {attachment}")
         
         try:
-            message = {
-                "sender_id": ObjectId(sender_id),
-                "recipient_id": ObjectId(recipient_id),
-                "content": content,
-                "message_type": message_type,
-                "attachment": attachment,
-                "created_at": datetime.datetime.now(timezone.utc),
-                "updated_at": datetime.datetime.now(timezone.utc),
-                "status": Message.STATUS_SENT,
-                "is_deleted": False,
-                "room_id" : f"{min(sender_id, recipient_id)}_{max(sender_id, recipient_id)}",  # Generate a consistent room ID for the message
-            }
+            message = Message.build(sender_id, recipient_id, content, message_type, attachment)
             
             print(f"[MESSAGE CREATE] Inserting into database: {message}")
             result = mongo.db.messages.insert_one(message)
             print(f"[MESSAGE CREATE] Insert result: {result.inserted_id}")
-            message["_id"] = result.inserted_id
             
             # Verify the message was actually saved
             saved_message = mongo.db.messages.find_one({"_id": result.inserted_id})
@@ -58,6 +80,14 @@ class Message:
             print(f"[MESSAGE CREATE] ❌ ERROR: {str(e)}")
             raise
     
+    @staticmethod
+    def insert_many(messages):
+        """Save several built messages in a single unordered write"""
+        if not messages:
+            return 0
+        result = mongo.db.messages.insert_many(messages, ordered=False)
+        return len(result.inserted_ids)
+    
     @staticmethod
     def get_by_id(message_id):
         """Get message by ID"""
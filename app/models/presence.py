@@ -1,7 +1,73 @@
 import datetime
+import os
 from bson import ObjectId
 from app import mongo
 
+# Online keys that are not refreshed (heartbeat or reconnect) expire after this long
+PRESENCE_TTL_SECONDS = 90
+
+# While a user stays online, their MongoDB last_updated/last_seen are rewritten this often
+PRESENCE_DB_SYNC_SECONDS = int(os.environ.get('PRESENCE_DB_SYNC_SECONDS', 600))
+
+class PresenceCache:
+    """Online flags shared by every worker through Redis.
+    
+    Each online user has a presence:<user_id> key with a TTL; the key
+    expiring is what turns a silently dropped user offline.
+    """
+    
+    def __init__(self, redis_url):
+        import redis
+        self._redis = redis.Redis.from_url(redis_url, decode_responses=True)
+    
+    @staticmethod
+    def _key(user_id):
+        return f"presence:{user_id}"
+    
+    @staticmethod
+    def _synced_key(user_id):
+        return f"presence_synced:{user_id}"
+    
+    def refresh(self, user_ids):
+        """Set or extend the online keys in one round-trip
+        
+        Returns the users whose MongoDB record is due a write: those that were not
+        online yet, and those last written more than PRESENCE_DB_SYNC_SECONDS ago.
+        """
+        pipe = self._redis.pipeline()
+        for user_id in user_ids:
+            pipe.set(self._key(user_id), Presence.STATUS_ONLINE, ex=PRESENCE_TTL_SECONDS, get=True)
+            pipe.set(self._synced_key(user_id), 1, ex=PRESENCE_DB_SYNC_SECONDS, nx=True)
+        results = pipe.execute()
+        return [user_id for user_id, was, due in zip(user_ids, results[::2], results[1::2])
+                if was is None or due]
+    
+    def clear(self, user_id):
+        """Drop a user's online key"""
+        self._redis.delete(self._key(user_id), self._synced_key(user_id))
+    
+    def online(self, user_ids):
+        """Get the subset of user_ids (as strings) whose online key is set"""
+        user_ids = [str(user_id) for user_id in user_ids]
+        if not user_ids:
+            return set()
+        values = self._redis.mget([self._key(user_id) for user_id in user_ids])
+        return {user_id for user_id, value in zip(user_ids, values) if value}
+
+def create_presence_cache(redis_url=None):
+    """Keep online flags in Redis when configured, else presence lives only in MongoDB"""
+    if redis_url:
+        return PresenceCache(redis_url)
+    return None
+
+# Set from the app's REDIS_URL by init_presence_cache
+presence_cache = None
+
+def init_presence_cache(redis_url):
+    """Keep online flags in the Redis the app is configured with, if any"""
+    global presence_cache
+    presence_cache = create_presence_cache(redis_url)
+
 class Presence:
     """Presence model for tracking user online/offline status."""
     
@@ -17,6 +83,14 @@ class Presence:
         - user_id: ID of the user
         - status: Status (online, offline)
         """
+        if presence_cache:
+            if status == Presence.STATUS_ONLINE:
+                # Already online and written recently: refreshing the key is all a heartbeat needs
+                if not presence_cache.refresh([str(user_id)]):
+                    return True
+            else:
+                presence_cache.clear(user_id)
+        
         now = datetime.datetime.utcnow()
         
         # Find existing presence record
@@ -50,9 +124,50 @@ class Presence:
         
         return True
     
+    @staticmethod
+    def bulk_refresh(user_ids):
+        """
+        Mark many users online in one write per collection (the periodic presence heartbeat)
+        
+        Parameters:
+        - user_ids: IDs of the connected users; their presence records exist from connect
+        """
+        if not user_ids:
+            return 0
+        
+        if presence_cache:
+            # Only users whose key had lapsed, or whose record is due a write, are touched
+            user_ids = presence_cache.refresh(list(user_ids))
+            if not user_ids:
+                return 0
+        
+        now = datetime.datetime.utcnow()
+        user_oids = [ObjectId(user_id) for user_id in user_ids]
+        
+        result = mongo.db.presence.update_many(
+            {"user_id": {"$in": user_oids}},
+            {"$set": {"status": Presence.STATUS_ONLINE, "last_updated": now}}
+        )
+        mongo.db.users.update_many(
+            {"_id": {"$in": user_oids}},
+            {"$set": {"last_seen": now}}
+        )
+        
+        return result.modified_count
+    
+    @staticmethod
+    def online_user_ids(user_ids):
+        """Get the ids (as strings) of the users flagged online in Redis, or None without a cache"""
+        if not presence_cache:
+            return None
+        return presence_cache.online(user_ids)
+    
     @staticmethod
     def get_status(user_id):
         """Get a user's current status"""
+        if presence_cache:
+            return Presence.STATUS_ONLINE if presence_cache.online([user_id]) else Presence.STATUS_OFFLINE
+        
         presence = mongo.db.presence.find_one({"user_id": ObjectId(user_id)})
         
         if not presence:
@@ -89,6 +204,7 @@ class Presence:
         
         # Create a lookup dictionary
         presence_by_id = {str(p["user_id"]): p for p in presence_list}
+        online_ids = Presence.online_user_ids(contact_ids)
         
         # Get basic user info for all contacts
         users = list(mongo.db.users.find(
@@ -104,7 +220,9 @@ class Presence:
             
             # Check if online status is stale
             status = presence_data.get("status", Presence.STATUS_OFFLINE)
-            if status == Presence.STATUS_ONLINE:
+            if online_ids is not None:
+                status = Presence.STATUS_ONLINE if user_id_str in online_ids else Presence.STATUS_OFFLINE
+            elif status == Presence.STATUS_ONLINE:
                 if "last_updated" in presence_data:
                     time_diff = datetime.datetime.utcnow() - presence_data["last_updated"]
                     if time_diff.total_seconds() > 600:  # 10 minutes instead of 2
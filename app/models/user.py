@@ -1,6 +1,8 @@
 import datetime
+import os
 import bcrypt
 import secrets
+import time
 from bson import ObjectId
 from app import mongo
 from app.models.media import Media
@@ -8,6 +10,16 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# bcrypt work factor; 12 for production, drop to 4 in dev/CI to keep hashing cheap
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", 12))
+
+# Sender fields stamped on every chat message: user_id -> (username, profile_picture, email, cached_until)
+_sender_profile_cache = {}
+
+# Profiles change rarely; other workers' caches converge within the TTL after an update
+SENDER_PROFILE_TTL = 300
+SENDER_PROFILE_CACHE_SIZE = 50000
+
 class User:
     """User model for authentication and profile management."""
     
@@ -17,7 +29,7 @@ class User:
         Create a new user with hashed password
         """
         # Hash the password with bcrypt
-        hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+        hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(BCRYPT_ROUNDS))
         
         # Prepare user document
         user = {
@@ -58,6 +70,51 @@ class User:
             user.pop("password_history", None)
         return user
     
+    @staticmethod
+    def get_public_by_id(user_id):
+        """Get only the public profile fields of a user by ID"""
+        return mongo.db.users.find_one(
+            {"_id": ObjectId(user_id)},
+            {"username": 1, "full_name": 1, "profile_picture": 1}
+        )
+    
+    @staticmethod
+    def _cached_profile(user_id):
+        """Get a user's (username, profile_picture, email), cached for SENDER_PROFILE_TTL seconds"""
+        user_id = str(user_id)
+        cached = _sender_profile_cache.get(user_id)
+        if cached and cached[3] > time.monotonic():
+            return cached
+        
+        user = mongo.db.users.find_one(
+            {"_id": ObjectId(user_id)},
+            {"username": 1, "profile_picture": 1, "email": 1}
+        ) or {}
+        cached = (user.get("username", ""), user.get("profile_picture", ""), user.get("email"),
+                  time.monotonic() + SENDER_PROFILE_TTL)
+        
+        if len(_sender_profile_cache) >= SENDER_PROFILE_CACHE_SIZE:
+            _sender_profile_cache.clear()
+        _sender_profile_cache[user_id] = cached
+        return cached
+    
+    @staticmethod
+    def get_sender_profile(user_id):
+        """Get a user's (username, profile_picture), cached for SENDER_PROFILE_TTL seconds"""
+        username, profile_picture, _, _ = User._cached_profile(user_id)
+        return username, profile_picture
+    
+    @staticmethod
+    def get_message_identity(user_id):
+        """Get a user's (username, email) as denormalized onto messages, from the same cache"""
+        username, _, email, _ = User._cached_profile(user_id)
+        return username, email
+    
+    @staticmethod
+    def forget_sender_profile(user_id):
+        """Drop a cached sender profile after the user changes it"""
+        _sender_profile_cache.pop(str(user_id), None)
+    
     @staticmethod
     def get_by_email(email):
         """Get user by email"""
@@ -114,13 +171,15 @@ class User:
         with mongo.cx.start_session() as session:
             with session.start_transaction():
                 try:
+                    user_oid = ObjectId(user_id)
+                    
                     # Check if username or email is being updated and ensure uniqueness
                     if "username" in update_dict:
                         existing = mongo.db.users.find_one(
                             {"username": update_dict["username"]}, 
                             session=session
                         )
-                        if existing and str(existing["_id"]) != user_id:
+                        if existing and existing["_id"] != user_oid:
                             session.abort_transaction()
                             return {"success": False, "message": "Username already taken"}
                             
@@ -129,7 +188,7 @@ class User:
                             {"email": update_dict["email"]}, 
                             session=session
                         )
-                        if existing and str(existing["_id"]) != user_id:
+                        if existing and existing["_id"] != user_oid:
                             session.abort_transaction()
                             return {"success": False, "message": "Email already registered"}
                     
@@ -138,7 +197,7 @@ class User:
                     
                     # Update user profile
                     result = mongo.db.users.update_one(
-                        {"_id": ObjectId(user_id)},
+                        {"_id": user_oid},
                         {"$set": update_dict},
                         session=session
                     )
@@ -149,7 +208,7 @@ class User:
                     
                     # Log the profile update in audit trail
                     audit_entry = {
-                        "user_id": ObjectId(user_id),
+                        "user_id": user_oid,
                         "action": "profile_update",
                         "fields_updated": list(update_dict.keys()),
                         "timestamp": datetime.datetime.utcnow(),
@@ -161,6 +220,7 @@ class User:
                     
                     # Commit the transaction
                     session.commit_transaction()
+                    User.forget_sender_profile(user_id)
                     return {"success": True, "message": "Profile updated successfully"}
                     
                 except Exception as e:
@@ -180,9 +240,11 @@ class User:
         with mongo.cx.start_session() as session:
             with session.start_transaction():
                 try:
+                    user_oid = ObjectId(user_id)
+                    
                     # Get current user settings for comparison
                     current_user = mongo.db.users.find_one(
-                        {"_id": ObjectId(user_id)}, 
+                        {"_id": user_oid}, 
                         {"settings": 1},
                         session=session
                     )
@@ -198,7 +260,7 @@ class User:
                     
                     # Update user settings
                     result = mongo.db.users.update_one(
-                        {"_id": ObjectId(user_id)},
+                        {"_id": user_oid},
                         {"$set": update_dict},
                         session=session
                     )
@@ -217,7 +279,7 @@ class User:
                     
                     if changes:
                         settings_log_entry = {
-                            "user_id": ObjectId(user_id),
+                            "user_id": user_oid,
                             "action": "settings_update",
                             "changes": changes,
                             "timestamp": datetime.datetime.utcnow(),
@@ -231,7 +293,7 @@ class User:
                     if "notifications_enabled" in settings and not settings["notifications_enabled"]:
                         mongo.db.notifications.update_many(
                             {
-                                "user_id": ObjectId(user_id),
+                                "user_id": user_oid,
                                 "is_read": False
                             },
                             {
@@ -264,9 +326,11 @@ class User:
         with mongo.cx.start_session() as session:
             with session.start_transaction():
                 try:
+                    user_oid = ObjectId(user_id)
+                    
                     # Get user with current password and history
                     user = mongo.db.users.find_one(
-                        {"_id": ObjectId(user_id)}, 
+                        {"_id": user_oid}, 
                         session=session
                     )
                     
@@ -287,7 +351,7 @@ class User:
                             return {"success": False, "message": "New password cannot be the same as any of your last 5 passwords"}
                     
                     # Hash the new password
-                    new_hashed_password = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt())
+                    new_hashed_password = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt(BCRYPT_ROUNDS))
                     
                     # Update password history (keep last 5)
                     if len(password_history) >= 5:
@@ -296,7 +360,7 @@ class User:
                     
                     # Update the password
                     result = mongo.db.users.update_one(
-                        {"_id": ObjectId(user_id)},
+                        {"_id": user_oid},
                         {
                             "$set": {
                                 "password": new_hashed_password,
@@ -314,7 +378,7 @@ class User:
                     
                     # Log the password change in security audit
                     security_log_entry = {
-                        "user_id": ObjectId(user_id),
+                        "user_id": user_oid,
                         "action": "password_change",
                         "timestamp": datetime.datetime.utcnow(),
                         "ip_address": None,  # Could be passed from request context
@@ -326,7 +390,7 @@ class User:
                     
                     # Invalidate all existing sessions for this user (security measure)
                     mongo.db.user_sessions.update_many(
-                        {"user_id": ObjectId(user_id)},
+                        {"user_id": user_oid},
                         {
                             "$set": {
                                 "is_valid": False,
@@ -361,16 +425,21 @@ class User:
         
         # Generate a token
         token = secrets.token_urlsafe(32)
-        expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=24)
+        now = datetime.datetime.utcnow()
+        expiry = now + datetime.timedelta(hours=24)
         
-        # Store the token in the database
-        mongo.db.password_reset_tokens.delete_many({"user_id": user["_id"]})  # Delete any existing tokens
-        mongo.db.password_reset_tokens.insert_one({
-            "user_id": user["_id"],
-            "token": token,
-            "expiry": expiry,
-            "created_at": datetime.datetime.utcnow()
-        })
+        # Store the token in the database, replacing any existing token for this user
+        # in a single round-trip (user_id is unique in password_reset_tokens)
+        mongo.db.password_reset_tokens.replace_one(
+            {"user_id": user["_id"]},
+            {
+                "user_id": user["_id"],
+                "token": token,
+                "expiry": expiry,
+                "created_at": now
+            },
+            upsert=True
+        )
         
         # In a real application, send an email with the token here
         # For demo purposes, just return success
@@ -399,7 +468,7 @@ class User:
             return {"success": False, "message": "User not found"}
         
         # Hash the new password
-        new_hashed_password = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt())
+        new_hashed_password = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt(BCRYPT_ROUNDS))
         
         # Update password history (keep last 5)
         password_history = user.get("password_history", [])
@@ -444,6 +513,7 @@ class User:
                     }
                 }
             )
+            User.forget_sender_profile(user_id)
             
             return {"success": result.modified_count > 0, "message": "Profile picture updated successfully"}
         except Exception as e:
@@ -471,6 +541,8 @@ class User:
                 }
             )
             
+            User.forget_sender_profile(user_id)
+            
             # Note: We're not deleting the actual media from GridFS 
             # as it might be referenced elsewhere or needed for history
             return {"success": result.modified_count > 0, "message": "Profile picture removed successfully"}
@@ -481,6 +553,8 @@ class User:
     def update_api_key(user_id, api_key):
         """Update user's API key with encryption"""
         try:
+            user_oid = ObjectId(user_id)
+            
             from app.utils.encryption import EncryptionManager
             
             # Encrypt the API key before storing
@@ -488,7 +562,7 @@ class User:
             
             # Update the user's API key
             result = mongo.db.users.update_one(
-                {"_id": ObjectId(user_id)},
+                {"_id": user_oid},
                 {
                     "$set": {
                         "api_key": encrypted_api_key,
@@ -504,7 +578,7 @@ class User:
             
             # Log the API key update in audit trail
             audit_entry = {
-                "user_id": ObjectId(user_id),
+                "user_id": user_oid,
                 "action": "api_key_update",
                 "timestamp": datetime.datetime.utcnow(),
                 "ip_address": None,  # Could be passed from request context
@@ -524,10 +598,12 @@ class User:
     def get_api_key(user_id):
         """Get and decrypt user's API key"""
         try:
+            user_oid = ObjectId(user_id)
+            
             from app.utils.encryption import EncryptionManager
             
             user = mongo.db.users.find_one(
-                {"_id": ObjectId(user_id)}, 
+                {"_id": user_oid}, 
                 {"api_key": 1}
             )
             
@@ -544,7 +620,7 @@ class User:
                 
                 # Remove the corrupted API key from the database
                 mongo.db.users.update_one(
-                    {"_id": ObjectId(user_id)},
+                    {"_id": user_oid},
                     {"$unset": {"api_key": "", "api_key_updated_at": ""}}
                 )
                 
@@ -558,9 +634,11 @@ class User:
     def remove_api_key(user_id):
         """Remove user's API key"""
         try:
+            user_oid = ObjectId(user_id)
+            
             # Update the user document to remove the API key
             result = mongo.db.users.update_one(
-                {"_id": ObjectId(user_id)},
+                {"_id": user_oid},
                 {
                     "$unset": {
                         "api_key": "",
@@ -577,7 +655,7 @@ class User:
             
             # Log the API key removal in audit trail
             audit_entry = {
-                "user_id": ObjectId(user_id),
+                "user_id": user_oid,
                 "action": "api_key_removal",
                 "timestamp": datetime.datetime.utcnow(),
                 "ip_address": None,  # Could be passed from request context
@@ -1,30 +1,175 @@
+import base64
 import datetime
+import logging
+import os
 from datetime import timezone
-from bson import ObjectId
+from bson import ObjectId, json_util
+from pymongo import IndexModel, ASCENDING, DESCENDING
+from pymongo.errors import PyMongoError
 from app import mongo
 
+logger = logging.getLogger(__name__)
+
+# Collection handles of the materialized views, populated on first read
+_VIEWS = {
+    "conversation_summary": None,
+    "user_activity_summary": None,
+    "group_analytics_summary": None,
+    "file_usage_summary": None
+}
+
+# Chat messages are stamped with created_at when sent but saved later by the batch writer
+# (after up to MESSAGE_FLUSH_INTERVAL, plus write retries). Refresh windows end this far in
+# the past so no message can be inserted behind a watermark; the next refresh picks it up.
+WATERMARK_LAG = datetime.timedelta(seconds=float(os.environ.get('MESSAGE_FLUSH_INTERVAL', 0.02)) + 30)
+
+def _get_view(name):
+    """Get the cached collection handle of a known view"""
+    if name not in _VIEWS:
+        raise ValueError(f"Unknown view: {name}")
+    
+    collection = _VIEWS[name]
+    if collection is None:
+        collection = _VIEWS[name] = mongo.db.get_collection(name)
+    return collection
+
 class DatabaseViews:
-    """Database views for enhanced analytics and complex queries."""
+    """Database views for enhanced analytics and complex queries.
+    
+    Each view is materialized into a regular collection by ending its pipeline
+    with a $merge stage, so reads are plain indexed finds and the aggregation
+    cost is only paid when the views are refreshed.
+    """
+    
+    # Collections that may be read through get_view_data, with the key their
+    # pages are ordered by (descending, ties broken by _id)
+    VIEW_SORT_KEYS = {
+        "conversation_summary": "last_message_time",
+        "user_activity_summary": "total_messages",
+        "group_analytics_summary": "total_messages",
+        "file_usage_summary": "total_size_mb"
+    }
+    VIEW_NAMES = frozenset(VIEW_SORT_KEYS)
+    
+    # Indexes each view needs to serve its dashboard queries without a sort
+    VIEW_INDEXES = {
+        "conversation_summary": [
+            IndexModel([("last_message_time", DESCENDING), ("_id", DESCENDING)]),
+            IndexModel([("all_participants", ASCENDING)])
+        ],
+        "user_activity_summary": [
+            IndexModel([("total_messages", DESCENDING), ("_id", DESCENDING)])
+        ],
+        "group_analytics_summary": [
+            IndexModel([("total_messages", DESCENDING), ("_id", DESCENDING)])
+        ],
+        "file_usage_summary": [
+            IndexModel([("total_size_mb", DESCENDING), ("_id", DESCENDING)])
+        ]
+    }
+    
+    DEFAULT_VIEW_LIMIT = 1000
+    MAX_VIEW_LIMIT = 10000
+    
+    # Refresh aggregations spill to disk, and are killed if they run away
+    REFRESH_BATCH_SIZE = 1000
+    REFRESH_MAX_TIME_MS = 10 * 60 * 1000
     
     @staticmethod
-    def create_conversation_summary_view():
-        """Create a view that aggregates conversation data for quick access"""
+    def _drop_legacy_view(name):
+        """Drop a standard (non-materialized) view left over from older deployments"""
+        if mongo.db.list_collection_names(filter={"name": name, "type": "view"}):
+            mongo.db.drop_collection(name)
+    
+    @staticmethod
+    def _materialize(source, name, pipeline, when_matched="replace", hint=None):
+        """Run a pipeline over the source collection and merge its output into name"""
+        DatabaseViews._drop_legacy_view(name)
+        
+        options = {
+            "allowDiskUse": True,
+            "batchSize": DatabaseViews.REFRESH_BATCH_SIZE,
+            "maxTimeMS": DatabaseViews.REFRESH_MAX_TIME_MS
+        }
+        if hint:
+            options["hint"] = hint
+        
+        mongo.db[source].aggregate(
+            pipeline + [{
+                "$merge": {
+                    "into": name,
+                    "on": "_id",
+                    "whenMatched": when_matched,
+                    "whenNotMatched": "insert"
+                }
+            }],
+            **options
+        )
+    
+    @staticmethod
+    def _ensure_indexes(name):
+        """Create the indexes of a view once, recording them in a manifest so refreshes skip it"""
+        index_names = sorted(index.document["name"] for index in DatabaseViews.VIEW_INDEXES[name])
+        
+        state = mongo.db.view_refresh_state.find_one({"_id": name}, {"indexes": 1})
+        if state and state.get("indexes") == index_names:
+            return
+        
+        mongo.db[name].create_indexes(DatabaseViews.VIEW_INDEXES[name])
+        mongo.db.view_refresh_state.update_one(
+            {"_id": name},
+            {"$set": {"view_name": name, "indexes": index_names}},
+            upsert=True
+        )
+    
+    @staticmethod
+    def _get_watermark(name):
+        """Get the created_at watermark of the last successful refresh of a view"""
+        state = mongo.db.view_refresh_state.find_one({"_id": name})
+        return state.get("last_refreshed_at") if state else None
+    
+    @staticmethod
+    def _set_watermark(name, refreshed_at):
+        """Record that a view includes every source document created up to refreshed_at"""
+        mongo.db.view_refresh_state.update_one(
+            {"_id": name},
+            {"$set": {"view_name": name, "last_refreshed_at": refreshed_at}},
+            upsert=True
+        )
+    
+    @staticmethod
+    def _created_at_window(name, full):
+        """Build the created_at filter for a refresh and return it with the new watermark.
+        
+        Incremental refreshes only process documents created since the stored
+        watermark; a full rebuild (or a view that was never built) processes all.
+        """
+        refreshed_at = datetime.datetime.now(timezone.utc) - WATERMARK_LAG
+        watermark = None if full else DatabaseViews._get_watermark(name)
+        
+        created_at = {"$lte": refreshed_at}
+        if watermark:
+            created_at["$gt"] = watermark
+        
+        return created_at, watermark, refreshed_at
+    
+    @staticmethod
+    def refresh_conversation_summary_view(full=False):
+        """Refresh the materialized view that aggregates conversation data for quick access"""
         try:
-            # Drop existing view if it exists
-            try:
-                mongo.db.conversation_summary.drop()
-            except:
-                pass
+            created_at, watermark, refreshed_at = DatabaseViews._created_at_window("conversation_summary", full)
             
             pipeline = [
                 {
-                    "$match": {"is_deleted": False}
+                    "$match": {"is_deleted": False, "created_at": created_at}
                 },
                 {
                     "$group": {
                         "_id": "$room_id",
                         "participant_1": {"$first": "$sender_id"},
                         "participant_2": {"$first": "$recipient_id"},
+                        "participant_1_name": {"$first": "$sender_username"},
+                        "participant_2_name": {"$first": "$recipient_username"},
                         "all_participants": {"$addToSet": {"$ifNull": ["$sender_id", "$recipient_id"]}},
                         "last_message": {"$last": "$content"},
                         "last_message_time": {"$max": "$created_at"},
@@ -38,84 +183,79 @@ class DatabaseViews:
                         "first_message_time": {"$min": "$created_at"}
                     }
                 },
-                {
-                    "$lookup": {
-                        "from": "users",
-                        "localField": "participant_1",
-                        "foreignField": "_id",
-                        "as": "user1_info"
-                    }
-                },
-                {
-                    "$lookup": {
-                        "from": "users",
-                        "localField": "participant_2", 
-                        "foreignField": "_id",
-                        "as": "user2_info"
-                    }
-                },
                 {
                     "$addFields": {
                         "conversation_name": {
                             "$cond": {
-                                "if": {"$and": [
-                                    {"$gt": [{"$size": "$user1_info"}, 0]},
-                                    {"$gt": [{"$size": "$user2_info"}, 0]}
-                                ]},
+                                "if": {"$and": ["$participant_1_name", "$participant_2_name"]},
                                 "then": {
-                                    "$concat": [
-                                        {"$arrayElemAt": ["$user1_info.username", 0]},
-                                        " ↔ ",
-                                        {"$arrayElemAt": ["$user2_info.username", 0]}
-                                    ]
+                                    "$concat": ["$participant_1_name", " ↔ ", "$participant_2_name"]
                                 },
                                 "else": "Unknown Conversation"
                             }
                         }
                     }
-                },
+                }
+            ]
+            
+            # Fold the new messages into existing conversations
+            when_matched = "replace" if watermark is None else [
                 {
-                    "$sort": {"last_message_time": -1}
+                    "$set": {
+                        "all_participants": {"$setUnion": ["$all_participants", "$$new.all_participants"]},
+                        "last_message": "$$new.last_message",
+                        "last_message_type": "$$new.last_message_type",
+                        "last_message_time": {"$max": ["$last_message_time", "$$new.last_message_time"]},
+                        "first_message_time": {"$min": ["$first_message_time", "$$new.first_message_time"]},
+                        "total_messages": {"$add": ["$total_messages", "$$new.total_messages"]},
+                        "unread_count": {"$add": ["$unread_count", "$$new.unread_count"]}
+                    }
                 }
             ]
             
-            # Create the view
-            mongo.db.create_collection("conversation_summary", 
-                                      viewOn="messages", 
-                                      pipeline=pipeline)
+            # Materialize the view and make sure its indexes exist
+            DatabaseViews._materialize("messages", "conversation_summary", pipeline, when_matched)
+            DatabaseViews._ensure_indexes("conversation_summary")
+            DatabaseViews._set_watermark("conversation_summary", refreshed_at)
             
-            print("Conversation summary view created successfully")
+            logger.info("Conversation summary view materialized")
             return True
             
-        except Exception as e:
-            print(f"Error creating conversation summary view: {e}")
+        except PyMongoError:
+            logger.exception("Error creating conversation summary view")
             return False
     
     @staticmethod
-    def create_user_activity_view():
-        """Create a view for comprehensive user activity analytics"""
+    def refresh_user_activity_view(full=False):
+        """Refresh the view for comprehensive user activity analytics"""
         try:
-            # Drop existing view if it exists
-            try:
-                mongo.db.user_activity_summary.drop()
-            except:
-                pass
+            created_at, watermark, refreshed_at = DatabaseViews._created_at_window("user_activity_summary", full)
             
             pipeline = [
+                {
+                    # Narrow the input first so the $group runs over an index-selected subset
+                    "$match": {"is_deleted": False, "sender_id": {"$ne": None}, "created_at": created_at}
+                },
                 {
                     "$group": {
                         "_id": "$sender_id",
                         "total_messages": {"$sum": 1},
                         "last_message_time": {"$max": "$created_at"},
                         "first_message_time": {"$min": "$created_at"},
-                        "message_types": {
-                            "$push": "$message_type"
+                        "text_messages": {
+                            "$sum": {"$cond": [{"$eq": ["$message_type", "text"]}, 1, 0]}
+                        },
+                        "media_messages": {
+                            "$sum": {"$cond": [{"$ne": ["$message_type", "text"]}, 1, 0]}
                         },
                         "avg_message_length": {
                             "$avg": {"$strLenCP": "$content"}
                         },
-                        "messages_by_day": {
-                            "$push": {
+                        "username": {"$last": "$sender_username"},
+                        "email": {"$last": "$sender_email"},
+                        # Only distinct days are kept, so memory is O(active days) per sender
+                        "active_days_set": {
+                            "$addToSet": {
                                 "$dateToString": {
                                     "format": "%Y-%m-%d",
                                     "date": "$created_at"
@@ -126,45 +266,14 @@ class DatabaseViews:
                 },
                 {
                     "$addFields": {
-                        "text_messages": {
-                            "$size": {
-                                "$filter": {
-                                    "input": "$message_types",
-                                    "cond": {"$eq": ["$$this", "text"]}
-                                }
-                            }
-                        },
-                        "media_messages": {
-                            "$size": {
-                                "$filter": {
-                                    "input": "$message_types",
-                                    "cond": {"$ne": ["$$this", "text"]}
-                                }
-                            }
-                        },
-                        "active_days": {
-                            "$size": {
-                                "$setUnion": ["$messages_by_day", []]
-                            }
-                        }
+                        "active_days": {"$size": "$active_days_set"}
                     }
                 },
-                {
-                    "$lookup": {
-                        "from": "users",
-                        "localField": "_id",
-                        "foreignField": "_id",
-                        "as": "user_info"
-                    }
-                },
-                {
-                    "$unwind": "$user_info"
-                },
                 {
                     "$project": {
                         "user_id": "$_id",
-                        "username": "$user_info.username",
-                        "email": "$user_info.email",
+                        "username": 1,
+                        "email": 1,
                         "total_messages": 1,
                         "text_messages": 1,
                         "media_messages": 1,
@@ -172,161 +281,231 @@ class DatabaseViews:
                         "first_message_time": 1,
                         "avg_message_length": {"$round": ["$avg_message_length", 2]},
                         "active_days": 1,
+                        "active_days_set": 1,
                         "messages_per_day": {
                             "$round": [{"$divide": ["$total_messages", "$active_days"]}, 2]
                         }
                     }
+                }
+            ]
+            
+            # Fold the new messages into existing per-user totals
+            when_matched = "replace" if watermark is None else [
+                {
+                    "$set": {
+                        "username": "$$new.username",
+                        "email": "$$new.email",
+                        "avg_message_length": {
+                            "$round": [
+                                {
+                                    "$divide": [
+                                        {"$add": [
+                                            {"$multiply": ["$avg_message_length", "$total_messages"]},
+                                            {"$multiply": ["$$new.avg_message_length", "$$new.total_messages"]}
+                                        ]},
+                                        {"$add": ["$total_messages", "$$new.total_messages"]}
+                                    ]
+                                },
+                                2
+                            ]
+                        },
+                        "total_messages": {"$add": ["$total_messages", "$$new.total_messages"]},
+                        "text_messages": {"$add": ["$text_messages", "$$new.text_messages"]},
+                        "media_messages": {"$add": ["$media_messages", "$$new.media_messages"]},
+                        "last_message_time": {"$max": ["$last_message_time", "$$new.last_message_time"]},
+                        "first_message_time": {"$min": ["$first_message_time", "$$new.first_message_time"]},
+                        "active_days_set": {"$setUnion": ["$active_days_set", "$$new.active_days_set"]}
+                    }
+                },
+                {
+                    "$set": {"active_days": {"$size": "$active_days_set"}}
                 },
                 {
-                    "$sort": {"total_messages": -1}
+                    "$set": {
+                        "messages_per_day": {
+                            "$round": [{"$divide": ["$total_messages", "$active_days"]}, 2]
+                        }
+                    }
                 }
             ]
             
-            # Create the view
-            mongo.db.create_collection("user_activity_summary", 
-                                      viewOn="messages", 
-                                      pipeline=pipeline)
+            # Materialize the view and make sure its indexes exist
+            DatabaseViews._materialize(
+                "messages",
+                "user_activity_summary",
+                pipeline,
+                when_matched,
+                hint=[("is_deleted", 1), ("sender_id", 1), ("created_at", -1)]
+            )
+            DatabaseViews._ensure_indexes("user_activity_summary")
+            DatabaseViews._set_watermark("user_activity_summary", refreshed_at)
             
-            print("User activity summary view created successfully")
+            logger.info("User activity summary view materialized")
             return True
             
-        except Exception as e:
-            print(f"Error creating user activity view: {e}")
+        except PyMongoError:
+            logger.exception("Error creating user activity view")
             return False
     
     @staticmethod
-    def create_group_analytics_view():
-        """Create a view for group analytics and statistics"""
+    def refresh_group_analytics_view(full=False):
+        """Refresh the view for group analytics and statistics
+        
+        This is a projection over the (small) groups collection, so it is
+        always rebuilt in full.
+        """
         try:
-            # Drop existing view if it exists
-            try:
-                mongo.db.group_analytics_summary.drop()
-            except:
-                pass
+            # Message counters are maintained on the group document by
+            # GroupMessage.create, so this view is a pure projection over groups
+            days_active = {
+                "$cond": {
+                    "if": {"$and": ["$first_message_time", "$last_message_time"]},
+                    "then": {
+                        "$max": [
+                            1,  # minimum 1 day
+                            {
+                                "$divide": [
+                                    {"$subtract": ["$last_message_time", "$first_message_time"]},
+                                    86400000  # milliseconds in a day
+                                ]
+                            }
+                        ]
+                    },
+                    "else": 1
+                }
+            }
             
             pipeline = [
-                {
-                    "$lookup": {
-                        "from": "group_messages",
-                        "localField": "_id",
-                        "foreignField": "group_id",
-                        "as": "messages"
-                    }
-                },
-                {
-                    "$addFields": {
-                        "member_count": {"$size": "$members"},
-                        "admin_count": {"$size": "$admins"},
-                        "total_messages": {"$size": "$messages"},
-                        "last_message_time": {"$max": "$messages.created_at"},
-                        "first_message_time": {"$min": "$messages.created_at"}
-                    }
-                },
-                {
-                    "$addFields": {
-                        "days_active": {
-                            "$cond": {
-                                "if": {"$and": ["$first_message_time", "$last_message_time"]},
-                                "then": {
-                                    "$max": [
-                                        1,  # minimum 1 day
-                                        {
-                                            "$divide": [
-                                                {"$subtract": ["$last_message_time", "$first_message_time"]},
-                                                86400000  # milliseconds in a day
-                                            ]
-                                        }
-                                    ]
-                                },
-                                "else": 1
-                            }
-                        }
-                    }
-                },
-                {
-                    "$addFields": {
-                        "messages_per_day": {
-                            "$cond": {
-                                "if": {"$gt": ["$days_active", 0]},
-                                "then": {"$divide": ["$total_messages", "$days_active"]},
-                                "else": "$total_messages"
-                            }
-                        },
-                        "messages_per_member": {
-                            "$cond": {
-                                "if": {"$gt": ["$member_count", 0]},
-                                "then": {"$divide": ["$total_messages", "$member_count"]},
-                                "else": 0
-                            }
-                        }
-                    }
-                },
                 {
                     "$project": {
                         "group_id": "$_id",
                         "name": 1,
                         "description": 1,
                         "created_at": 1,
-                        "member_count": 1,
-                        "admin_count": 1,
-                        "total_messages": 1,
+                        "member_count": {"$size": "$members"},
+                        "admin_count": {"$size": "$admins"},
+                        "total_messages": {"$ifNull": ["$total_messages", 0]},
                         "last_message_time": 1,
                         "first_message_time": 1,
-                        "days_active": {"$round": ["$days_active", 1]},
-                        "messages_per_day": {"$round": ["$messages_per_day", 2]},
-                        "messages_per_member": {"$round": ["$messages_per_member", 2]},
+                        "days_active": {"$round": [days_active, 1]},
+                        "messages_per_day": {
+                            "$round": [
+                                {"$divide": [{"$ifNull": ["$total_messages", 0]}, days_active]},
+                                2
+                            ]
+                        },
+                        "messages_per_member": {
+                            "$let": {
+                                "vars": {"members": {"$size": "$members"}},
+                                "in": {
+                                    "$cond": {
+                                        "if": {"$gt": ["$$members", 0]},
+                                        "then": {
+                                            "$round": [
+                                                {"$divide": [{"$ifNull": ["$total_messages", 0]}, "$$members"]},
+                                                2
+                                            ]
+                                        },
+                                        "else": 0
+                                    }
+                                }
+                            }
+                        },
                         "is_active": 1
                     }
-                },
-                {
-                    "$sort": {"total_messages": -1}
                 }
             ]
             
-            # Create the view
-            mongo.db.create_collection("group_analytics_summary", 
-                                      viewOn="groups", 
-                                      pipeline=pipeline)
+            # Materialize the view and make sure its indexes exist
+            DatabaseViews._materialize("groups", "group_analytics_summary", pipeline)
+            DatabaseViews._ensure_indexes("group_analytics_summary")
             
-            print("Group analytics summary view created successfully")
+            logger.info("Group analytics summary view materialized")
             return True
             
-        except Exception as e:
-            print(f"Error creating group analytics view: {e}")
+        except PyMongoError:
+            logger.exception("Error creating group analytics view")
             return False
     
     @staticmethod
-    def create_file_usage_view():
-        """Create a view for file usage analytics"""
+    def refresh_file_usage_view(full=False):
+        """Refresh the view for file usage analytics
+        
+        Per-type totals are nested per uploader and download counts change on
+        existing files, so this view is always rebuilt in full.
+        """
         try:
-            # Drop existing view if it exists
-            try:
-                mongo.db.file_usage_summary.drop()
-            except:
-                pass
-            
             pipeline = [
                 {
                     "$match": {"is_deleted": False}
                 },
                 {
+                    # One pass over files per uploader; per-type totals are folded below
                     "$group": {
-                        "_id": {
-                            "uploader_id": "$uploader_id",
-                            "file_type": "$file_type"
+                        "_id": "$uploader_id",
+                        "total_files_all_types": {"$sum": 1},
+                        "total_size_all_types": {"$sum": "$file_size"},
+                        "total_downloads_all_types": {"$sum": "$download_count"},
+                        "per_type": {
+                            "$push": {
+                                "t": "$file_type",
+                                "s": {"$ifNull": ["$file_size", 0]},
+                                "d": {"$ifNull": ["$download_count", 0]}
+                            }
                         },
-                        "total_files": {"$sum": 1},
-                        "total_size": {"$sum": "$file_size"},
-                        "total_downloads": {"$sum": "$download_count"},
-                        "avg_file_size": {"$avg": "$file_size"},
                         "last_upload": {"$max": "$created_at"},
                         "first_upload": {"$min": "$created_at"}
                     }
                 },
                 {
+                    "$addFields": {
+                        "file_types": {
+                            "$reduce": {
+                                "input": "$per_type",
+                                "initialValue": [],
+                                "in": {
+                                    "$let": {
+                                        "vars": {"file": "$$this", "types": "$$value"},
+                                        "in": {
+                                            "$cond": [
+                                                {"$in": ["$$file.t", "$$types.type"]},
+                                                {
+                                                    "$map": {
+                                                        "input": "$$types",
+                                                        "as": "ft",
+                                                        "in": {
+                                                            "$cond": [
+                                                                {"$eq": ["$$ft.type", "$$file.t"]},
+                                                                {
+                                                                    "type": "$$ft.type",
+                                                                    "count": {"$add": ["$$ft.count", 1]},
+                                                                    "size": {"$add": ["$$ft.size", "$$file.s"]},
+                                                                    "downloads": {"$add": ["$$ft.downloads", "$$file.d"]}
+                                                                },
+                                                                "$$ft"
+                                                            ]
+                                                        }
+                                                    }
+                                                },
+                                                {
+                                                    "$concatArrays": [
+                                                        "$$types",
+                                                        [{"type": "$$file.t", "count": 1, "size": "$$file.s", "downloads": "$$file.d"}]
+                                                    ]
+                                                }
+                                            ]
+                                        }
+                                    }
+                                }
+                            }
+                        }
+                    }
+                },
+                {
+                    # Only one row per uploader is left, so this join is cheap
                     "$lookup": {
                         "from": "users",
-                        "localField": "_id.uploader_id",
+                        "localField": "_id",
                         "foreignField": "_id",
                         "as": "user_info"
                     }
@@ -334,31 +513,11 @@ class DatabaseViews:
                 {
                     "$unwind": "$user_info"
                 },
-                {
-                    "$group": {
-                        "_id": "$_id.uploader_id",
-                        "username": {"$first": "$user_info.username"},
-                        "email": {"$first": "$user_info.email"},
-                        "file_types": {
-                            "$push": {
-                                "type": "$_id.file_type",
-                                "count": "$total_files",
-                                "size": "$total_size",
-                                "downloads": "$total_downloads"
-                            }
-                        },
-                        "total_files_all_types": {"$sum": "$total_files"},
-                        "total_size_all_types": {"$sum": "$total_size"},
-                        "total_downloads_all_types": {"$sum": "$total_downloads"},
-                        "last_upload": {"$max": "$last_upload"},
-                        "first_upload": {"$min": "$first_upload"}
-                    }
-                },
                 {
                     "$project": {
                         "user_id": "$_id",
-                        "username": 1,
-                        "email": 1,
+                        "username": "$user_info.username",
+                        "email": "$user_info.email",
                         "file_types": 1,
                         "total_files": "$total_files_all_types",
                         "total_size_mb": {
@@ -374,64 +533,151 @@ class DatabaseViews:
                         "last_upload": 1,
                         "first_upload": 1
                     }
-                },
-                {
-                    "$sort": {"total_size_all_types": -1}
                 }
             ]
             
-            # Create the view
-            mongo.db.create_collection("file_usage_summary", 
-                                      viewOn="files", 
-                                      pipeline=pipeline)
+            # Materialize the view and make sure its indexes exist
+            DatabaseViews._materialize("files", "file_usage_summary", pipeline)
+            DatabaseViews._ensure_indexes("file_usage_summary")
             
-            print("File usage summary view created successfully")
+            logger.info("File usage summary view materialized")
             return True
             
-        except Exception as e:
-            print(f"Error creating file usage view: {e}")
+        except PyMongoError:
+            logger.exception("Error creating file usage view")
             return False
     
     @staticmethod
-    def create_all_views():
-        """Create all database views"""
-        print("Creating all database views...")
+    def create_all_views(full=True):
+        """Create all database views (full rebuild unless full=False)"""
+        logger.info("Creating all database views")
         
         results = {
-            "conversation_summary": DatabaseViews.create_conversation_summary_view(),
-            "user_activity": DatabaseViews.create_user_activity_view(),
-            "group_analytics": DatabaseViews.create_group_analytics_view(),
-            "file_usage": DatabaseViews.create_file_usage_view()
+            "conversation_summary": DatabaseViews.refresh_conversation_summary_view(full),
+            "user_activity": DatabaseViews.refresh_user_activity_view(full),
+            "group_analytics": DatabaseViews.refresh_group_analytics_view(full),
+            "file_usage": DatabaseViews.refresh_file_usage_view(full)
         }
         
         success_count = sum(results.values())
         total_count = len(results)
         
-        print(f"Created {success_count}/{total_count} views successfully")
+        logger.info("Created %d/%d views successfully", success_count, total_count)
         
         if success_count < total_count:
-            print("Failed views:", [name for name, success in results.items() if not success])
+            logger.warning("Failed views: %s", [name for name, success in results.items() if not success])
         
         return results
     
     @staticmethod
     def refresh_views():
-        """Refresh all views by recreating them"""
-        print("Refreshing all database views...")
-        return DatabaseViews.create_all_views()
+        """Incrementally refresh all materialized views from their watermarks.
+        
+        When the background scheduler is running the refresh is queued on it
+        instead of being executed on the calling thread.
+        """
+        from app.analytics.scheduler import enqueue_refresh
+        
+        if enqueue_refresh():
+            logger.info("Queued refresh of all database views")
+            return {name: True for name in DatabaseViews.VIEW_NAMES}
+        
+        logger.info("Refreshing all database views")
+        return DatabaseViews.create_all_views(full=False)
+    
+    @staticmethod
+    def encode_cursor(doc, view_name):
+        """Encode the sort key and _id of the last document of a page as an opaque cursor"""
+        sort_key = DatabaseViews.VIEW_SORT_KEYS[view_name]
+        raw = json_util.dumps([doc.get(sort_key), doc["_id"]])
+        return base64.urlsafe_b64encode(raw.encode()).decode()
     
     @staticmethod
-    def get_view_data(view_name, limit=None, skip=0):
-        """Get data from a specific view with optional pagination"""
+    def decode_cursor(cursor):
+        """Decode a cursor produced by encode_cursor into a (sort value, _id) pair"""
         try:
-            collection = getattr(mongo.db, view_name)
-            cursor = collection.find().skip(skip)
-            
-            if limit:
-                cursor = cursor.limit(limit)
-            
-            return list(cursor)
+            value, last_id = json_util.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+            return value, last_id
+        except (ValueError, TypeError):
+            raise ValueError("Invalid pagination cursor")
+    
+    @staticmethod
+    def iter_view_data(view_name, limit=1000, skip=0, projection=None, sort=None, after=None):
+        """Stream documents from a specific view in cursor batches
+        
+        When after (a (sort value, _id) pair) is given the page is located with a
+        range query on the view's sort index instead of skipping documents.
+        """
+        collection = _get_view(view_name)
+        
+        limit = min(limit or DatabaseViews.DEFAULT_VIEW_LIMIT, DatabaseViews.MAX_VIEW_LIMIT)
+        query = {}
+        
+        if after is not None:
+            sort_key = DatabaseViews.VIEW_SORT_KEYS[view_name]
+            value, last_id = after
+            query = {
+                "$or": [
+                    {sort_key: {"$lt": value}},
+                    {sort_key: value, "_id": {"$lt": last_id}}
+                ]
+            }
+            sort = [(sort_key, DESCENDING), ("_id", DESCENDING)]
+            skip = 0
+        
+        cursor = collection.find(
+            query,
+            projection=projection,
+            batch_size=min(limit, 500)
+        )
+        
+        # Views are stored unsorted; order at read time so the sort index can stop at limit
+        if sort is None:
+            sort = [(DatabaseViews.VIEW_SORT_KEYS[view_name], DESCENDING), ("_id", DESCENDING)]
+        
+        if sort:
+            cursor = cursor.sort(sort)
+        
+        yield from cursor.skip(skip).limit(limit)
+    
+    @staticmethod
+    def get_view_data(view_name, limit=1000, skip=0, projection=None, sort=None, after=None):
+        """Get data from a specific view with bounded pagination"""
+        if view_name not in _VIEWS:
+            raise ValueError(f"Unknown view: {view_name}")
+        
+        try:
+            return list(DatabaseViews.iter_view_data(
+                view_name, limit=limit, skip=skip, projection=projection, sort=sort, after=after
+            ))
             
-        except Exception as e:
-            print(f"Error getting data from view {view_name}: {e}")
-            return [] 
\ No newline at end of file
+        except PyMongoError:
+            logger.exception("Error getting data from view %s", view_name)
+            return []
+    
+    @staticmethod
+    def get_view_page(view_name, limit=20, after=None, projection=None):
+        """Get one keyset-paginated page from a view along with the cursor of the next page"""
+        if view_name not in _VIEWS:
+            raise ValueError(f"Unknown view: {view_name}")
+        
+        sort_key = DatabaseViews.VIEW_SORT_KEYS[view_name]
+        
+        limit = min(limit or DatabaseViews.DEFAULT_VIEW_LIMIT, DatabaseViews.MAX_VIEW_LIMIT)
+        
+        if projection is not None:
+            projection = {**projection, sort_key: 1}
+        
+        data = list(DatabaseViews.iter_view_data(
+            view_name,
+            limit=limit,
+            projection=projection,
+            sort=[(sort_key, DESCENDING), ("_id", DESCENDING)],
+            after=DatabaseViews.decode_cursor(after) if after else None
+        ))
+        
+        next_cursor = None
+        if data and len(data) == limit:
+            next_cursor = DatabaseViews.encode_cursor(data[-1], view_name)
+        
+        return data, next_cursor
@@ -1,7 +1,168 @@
-# Export the socketio instance initialization function
-# But don't define socketio here to avoid circular imports
+from flask import request
+from flask_socketio import SocketIO
+from bson import ObjectId
+import datetime
+import json
+import logging
 
-def get_socketio():
-    """Get the SocketIO instance from the current Flask app"""
-    from flask import current_app
-    return current_app.extensions.get('socketio')
+try:
+    import orjson
+except ImportError:  # packets are (de)serialized with the stdlib json module instead
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+def bson_default(obj):
+    """Encode the BSON types handlers put in payloads as-is.
+    
+    ObjectIds become their hex string and datetimes their isoformat(), the same
+    strings the REST API returns, so payloads need no conversion pass of their own.
+    """
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, datetime.datetime):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+class OrjsonJSON:
+    """Drop-in for the json module used to encode Socket.IO packets, backed by orjson"""
+    
+    @staticmethod
+    def dumps(obj, **kwargs):
+        # kwargs like separators are stdlib formatting options; orjson output is already compact.
+        # Datetimes are passed to bson_default so every serializer formats them alike
+        return orjson.dumps(
+            obj, default=bson_default, option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        ).decode()
+    
+    @staticmethod
+    def loads(s, **kwargs):
+        return orjson.loads(s)
+
+class BsonJSON:
+    """The stdlib json module, able to encode ObjectIds and datetimes in Socket.IO packets"""
+    
+    @staticmethod
+    def dumps(obj, **kwargs):
+        return json.dumps(obj, default=bson_default, **kwargs)
+    
+    @staticmethod
+    def loads(s, **kwargs):
+        return json.loads(s, **kwargs)
+
+def bson_msgpack_packet():
+    """msgpack packet class that encodes ObjectIds and datetimes like the JSON serializers do"""
+    import msgpack
+    from socketio.msgpack_packet import MsgPackPacket
+    
+    class BsonMsgPackPacket(MsgPackPacket):
+        def encode(self):
+            return msgpack.dumps(self._to_dict(), default=bson_default)
+    
+    return BsonMsgPackPacket
+
+def disable_websocket_deflate():
+    """Stop eventlet's WebSocket server from negotiating permessage-deflate.
+    
+    Only used when SOCKETIO_WEBSOCKET_DEFLATE is turned off. Once negotiated, eventlet
+    deflates every frame regardless of size: that saves bandwidth on multi-KB SDP offers
+    and ICE candidates but costs CPU on chat frames of a few hundred bytes.
+    """
+    from eventlet import websocket
+    
+    # Private eventlet hook (eventlet 0.26 and later); skip rather than break startup if it goes away
+    if not hasattr(websocket.WebSocketWSGI, '_negotiate_permessage_deflate'):
+        logger.warning("This eventlet version has no permessage-deflate hook; "
+                       "WebSocket compression is left as negotiated")
+        return
+    websocket.WebSocketWSGI._negotiate_permessage_deflate = lambda self, extensions: None
+
+# The single SocketIO instance for the app; bound to it in init_socketio
+socketio = SocketIO()
+
+def init_socketio(app):
+    """Bind the SocketIO instance to the app and register all socket event handlers"""
+    # Payloads may carry ObjectIds as-is; every serializer encodes them as strings
+    options = {'json': OrjsonJSON if orjson is not None else BsonJSON}
+    serializer = app.config.get('SOCKETIO_SERIALIZER', 'default')
+    if serializer == 'msgpack':
+        serializer = bson_msgpack_packet()
+    
+    # With a Redis message queue, emits are fanned out to every worker process
+    global ROOMS_ARE_LOCAL
+    ROOMS_ARE_LOCAL = not app.config.get('REDIS_URL')
+    socketio.init_app(
+        app,
+        cors_allowed_origins=[
+            app.config['FRONTEND'],
+            "http://localhost:3787"
+        ],
+        async_mode=app.config.get('SOCKETIO_ASYNC_MODE', 'eventlet'),
+        message_queue=app.config.get('REDIS_URL'),
+        channel='letsapp-socketio',
+        serializer=serializer,
+        **options
+    )
+    
+    # Multi-KB SDP offers and ICE candidates are compressed on both transports: WebSocket
+    # frames by eventlet's permessage-deflate, which stays on unless turned off here, and
+    # polling responses by engine.io's HTTP compression (on by default above 1024 bytes)
+    if socketio.async_mode == 'eventlet' and not app.config.get('SOCKETIO_WEBSOCKET_DEFLATE', True):
+        disable_websocket_deflate()
+    
+    # Handlers are plain functions doing blocking pymongo calls; they only yield to
+    # other sockets while waiting on Mongo when running on monkey-patched green threads
+    if socketio.async_mode not in ('eventlet', 'gevent', 'gevent_uwsgi'):
+        logger.warning("SocketIO is running in %s mode; database I/O in socket handlers "
+                       "will block other events", socketio.async_mode)
+    
+    # Store socketio instance in app for access from routes
+    app.socketio = socketio
+    
+    # Handler modules are imported here to avoid circular imports
+    from app.realtime.events import register_handlers as register_events
+    register_events(socketio)
+    
+    from app.realtime.presence import register_handlers as register_presence
+    register_presence(socketio)
+    
+    from app.realtime.typing import register_handlers as register_typing
+    register_typing(socketio)
+    
+    from app.realtime.chat import register_handlers as register_chat
+    register_chat(socketio)
+    
+    from app.realtime.group_chat import register_handlers as register_group_chat
+    register_group_chat(socketio)
+    
+    from app.realtime.calling import init_call_store, register_handlers as register_calling
+    init_call_store(app.config.get('REDIS_URL'))
+    register_calling(socketio)
+    
+    return socketio
+
+def join_rooms(rooms, sid=None, namespace=None):
+    """Add a socket (the current one by default) to several rooms in one pass.
+    
+    Room membership lives in the server's client manager (it is local even with
+    the Redis message queue), so this skips the per-call context lookups of
+    flask_socketio.join_room.
+    """
+    sid = sid or request.sid
+    namespace = namespace or request.namespace
+    for room in rooms:
+        socketio.server.enter_room(sid, room, namespace=namespace)
+
+# Without a message queue every socket is on this worker, so its room table is the whole picture;
+# set in init_socketio from the same REDIS_URL the message queue uses
+ROOMS_ARE_LOCAL = True
+
+def room_has_listeners(room, skip_sid=None, namespace='/'):
+    """Whether a room may hold a socket other than skip_sid (e.g. the sender's)"""
+    if not ROOMS_ARE_LOCAL:
+        # Listeners may be connected to another worker
+        return True
+    for sid, _ in socketio.server.manager.get_participants(namespace, room):
+        if sid != skip_sid:
+            return True
+    return False
@@ -0,0 +1,46 @@
+"""Chat attachment resolution for send_message.
+
+Kept free of Flask/Socket.IO imports and fully annotated so it can be compiled
+with mypyc (``mypyc app/realtime/_attach.py``); the pure-Python module is used
+when no compiled build is present.
+"""
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+from app.models.file import File
+
+logger = logging.getLogger(__name__)
+
+# Placeholder IDs some clients send when an upload has no document ID yet
+_MISSING_IDS = ('undefined', 'null')
+
+def resolve_attachment(payload: Dict[str, Any], sender_id: str, message_type: str,
+                       content: str) -> Tuple[Optional[Dict[str, Any]], str]:
+    """Turn a client attachment payload into (attachment_to_save, message_type)"""
+    media_doc_id: Optional[str] = payload.get('fileId') or payload.get('file_id')
+    if media_doc_id in _MISSING_IDS:
+        media_doc_id = None
+    original_filename: Optional[str] = payload.get('filename')
+    resolved_file_type: str = payload.get('type') or payload.get('file_type') or 'document'
+    
+    logger.debug("attachment id=%s filename=%s type=%s", media_doc_id, original_filename, resolved_file_type)
+    
+    file_info = File.resolve_attachment(sender_id, media_doc_id, original_filename, resolved_file_type)
+    if not file_info:
+        logger.warning("attachment not found for %r", payload)
+        # Keep original message_type if attachment fails, or reset if it was file-specific
+        if message_type != 'text' and not content:
+            message_type = 'text'
+        return None, message_type
+    
+    # Read each field once; the most reliable message_type comes from the retrieved file_info
+    get = file_info.get
+    file_type: str = get('media_type') or get('file_type') or resolved_file_type
+    attachment: Dict[str, Any] = {
+        "file_id": str(file_info['_id']),
+        "file_type": file_type,
+        "filename": get('original_filename', original_filename or ''),
+        "mime_type": get('mime_type', ''),
+        "size": get('file_size', 0)
+    }
+    return attachment, file_type
@@ -0,0 +1,133 @@
+import json
+
+# Fields of a call session that hold nested payloads (stored as JSON in Redis)
+JSON_FIELDS = ('caller_info', 'callee_info')
+
+# Calls that are never cleaned up (e.g. a crashed worker) expire after this long
+CALL_TTL_SECONDS = 3600
+
+class CallSession:
+    """One active call; slotted since signaling handlers read its fields on every event"""
+    
+    __slots__ = ('caller_id', 'callee_id', 'status', 'room_name', 'call_type',
+                 'caller_room', 'callee_room', 'caller_info', 'callee_info')
+    
+    def __init__(self, caller_id, callee_id, status, room_name, call_type,
+                 caller_room, callee_room, caller_info=None, callee_info=None):
+        self.caller_id = caller_id
+        self.callee_id = callee_id
+        self.status = status
+        self.room_name = room_name
+        self.call_type = call_type
+        self.caller_room = caller_room
+        self.callee_room = callee_room
+        # Participant payloads reused by every notification about this call
+        self.caller_info = caller_info
+        self.callee_info = callee_info
+
+class MemoryCallStore:
+    """Active call sessions kept in this process (single worker deployments)"""
+    
+    def __init__(self):
+        self._calls = {}       # call_id -> CallSession
+        self._user_calls = {}  # user_id -> call_id, for every participant of an active call
+    
+    def add(self, call_id, call_info):
+        """Store a new call session and index both participants"""
+        self._calls[call_id] = call_info
+        self._user_calls[call_info.caller_id] = call_id
+        self._user_calls[call_info.callee_id] = call_id
+    
+    def get(self, call_id):
+        """Get a call session or None"""
+        return self._calls.get(call_id)
+    
+    def set_status(self, call_id, status):
+        """Update the status of a call session"""
+        call_info = self._calls.get(call_id)
+        if call_info:
+            call_info.status = status
+    
+    def call_for_user(self, user_id):
+        """Get the id of the call a user is in, or None"""
+        return self._user_calls.get(user_id)
+    
+    def remove(self, call_id):
+        """Remove a call session and its participant index, returning the session"""
+        call_info = self._calls.pop(call_id, None)
+        if call_info:
+            for participant_id in (call_info.caller_id, call_info.callee_id):
+                if self._user_calls.get(participant_id) == call_id:
+                    del self._user_calls[participant_id]
+        return call_info
+
+class RedisCallStore:
+    """Active call sessions shared by every worker through Redis.
+    
+    Each call is a hash at call:<call_id> and each participant has a
+    user_call:<user_id> key pointing at it; all keys carry a TTL.
+    """
+    
+    def __init__(self, redis_url):
+        import redis
+        self._redis = redis.Redis.from_url(redis_url, decode_responses=True)
+    
+    @staticmethod
+    def _call_key(call_id):
+        return f"call:{call_id}"
+    
+    @staticmethod
+    def _user_key(user_id):
+        return f"user_call:{user_id}"
+    
+    def add(self, call_id, call_info):
+        """Store a new call session and index both participants in one round-trip"""
+        mapping = {}
+        for field in CallSession.__slots__:
+            value = getattr(call_info, field)
+            mapping[field] = json.dumps(value) if field in JSON_FIELDS else value
+        pipe = self._redis.pipeline()
+        pipe.hset(self._call_key(call_id), mapping=mapping)
+        pipe.expire(self._call_key(call_id), CALL_TTL_SECONDS)
+        pipe.set(self._user_key(call_info.caller_id), call_id, ex=CALL_TTL_SECONDS)
+        pipe.set(self._user_key(call_info.callee_id), call_id, ex=CALL_TTL_SECONDS)
+        pipe.execute()
+    
+    def get(self, call_id):
+        """Get a call session or None"""
+        call_info = self._redis.hgetall(self._call_key(call_id))
+        if not call_info:
+            return None
+        for field in JSON_FIELDS:
+            if field in call_info:
+                call_info[field] = json.loads(call_info[field])
+        return CallSession(**call_info)
+    
+    def set_status(self, call_id, status):
+        """Update the status of a call session"""
+        self._redis.hset(self._call_key(call_id), 'status', status)
+    
+    def call_for_user(self, user_id):
+        """Get the id of the call a user is in, or None"""
+        return self._redis.get(self._user_key(user_id))
+    
+    def remove(self, call_id):
+        """Remove a call session and its participant index, returning the session"""
+        call_info = self.get(call_id)
+        if not call_info:
+            return None
+        
+        pipe = self._redis.pipeline()
+        pipe.delete(self._call_key(call_id))
+        for participant_id in (call_info.caller_id, call_info.callee_id):
+            # Only clear the index if it still points at this call
+            if self._redis.get(self._user_key(participant_id)) == call_id:
+                pipe.delete(self._user_key(participant_id))
+        pipe.execute()
+        return call_info
+
+def create_call_store(redis_url=None):
+    """Use Redis when configured so all workers see the same calls, else process memory"""
+    if redis_url:
+        return RedisCallStore(redis_url)
+    return MemoryCallStore()
@@ -1,246 +1,295 @@
-from flask_socketio import emit, join_room, leave_room
+from flask_socketio import emit, join_room
 from flask import request
-from app import mongo
 from app.models.call import Call
 from app.models.user import User
-from flask_jwt_extended import decode_token
-from bson import ObjectId
+from app.realtime import socketio
+from app.realtime.call_store import CallSession, RedisCallStore, create_call_store
+from app.realtime.chat import validate_token
+from app.realtime.events import connected_users
 import datetime
+import functools
+import logging
+import queue
+import time
 from datetime import timezone
 
+logger = logging.getLogger(__name__)
+
 # Store active call sessions in memory for quick access
-active_calls = {}  # call_id -> {caller_id, callee_id, status, room_name}
+# (Redis-backed when REDIS_URL is set so every worker sees the same calls; see init_call_store)
+active_calls = create_call_store()
+
+# Call status writes that don't gate a reply, applied by call_db_writer: (call_id, status, timestamp)
+call_write_queue = queue.Queue()
+
+# Queued writes are flushed together after this long or once this many are pending
+CALL_WRITE_FLUSH_INTERVAL = 0.02
+CALL_WRITE_BATCH_SIZE = 100
+
+# Authenticated user per socket session; the token is fixed for the life of a connection
+sid_user_cache = {}  # sid -> user
+
+# Sessions whose token failed to verify, so repeated events skip the signature check
+sid_rejected = set()
+
+# Tokens outside these bounds can't be a JWT we issued
+MIN_TOKEN_LENGTH = 20
+MAX_TOKEN_LENGTH = 4096
+
+def init_call_store(redis_url):
+    """Keep active calls in Redis when the app has a REDIS_URL, the same one the message queue uses"""
+    global active_calls
+    active_calls = create_call_store(redis_url)
 
 def get_user_from_token():
     """Extract user from JWT token in socket session"""
+    sid = request.sid
+    if sid in sid_user_cache:
+        return sid_user_cache[sid]
+    if sid in sid_rejected:
+        return None
+    
     try:
         token = request.args.get('token')
         if not token:
             return None
         
-        payload = decode_token(token)
+        # Cheap shape check before the cryptographic one: header.payload.signature
+        if token.count('.') != 2 or not MIN_TOKEN_LENGTH <= len(token) <= MAX_TOKEN_LENGTH:
+            sid_rejected.add(sid)
+            return None
+        
+        # Shares the chat handlers' decoded-token cache
+        payload = validate_token(token)
         if not payload:
+            sid_rejected.add(sid)
             return None
             
         user_id = payload.get('sub')  # Use 'sub' as that's the standard JWT claim
         if not user_id:
             return None
             
-        user = User.get_by_id(user_id)
+        user = User.get_public_by_id(user_id)
+        if user:
+            sid_user_cache[sid] = user
         return user
     except Exception as e:
-        print(f"Error getting user from token: {e}")
+        logger.warning("Error getting user from token: %s", e)
         return None
 
+def authed(handler):
+    """Resolve the socket's user before running a handler, rejecting unauthenticated events"""
+    @functools.wraps(handler)
+    def wrapper(data=None):
+        user = get_user_from_token()
+        if not user:
+            emit('call_error', {'message': 'Authentication required'})
+            return
+        return handler(user, data or {})
+    return wrapper
+
+def call_db_writer():
+    """Apply queued call status writes off the socket handlers' request path in bulk"""
+    while True:
+        batch = [call_write_queue.get()]
+        deadline = time.monotonic() + CALL_WRITE_FLUSH_INTERVAL
+        
+        while len(batch) < CALL_WRITE_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(call_write_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        
+        try:
+            Call.bulk_update_statuses(batch)
+        except Exception as e:
+            logger.error("Error writing %d call status updates: %s", len(batch), e)
+
+def queue_call_status(call_id, status):
+    """Record a call status change now, writing it to the database in the background"""
+    call_write_queue.put((call_id, status, datetime.datetime.now(timezone.utc)))
+
+# Set once call_db_writer is running
+_call_db_writer_started = False
+
 def register_handlers(socketio):
-    """Register all Socket.IO event handlers for calling functionality"""
+    """Register all Socket.IO event handlers for calling functionality
+    
+    Handlers run on eventlet green threads (see init_socketio), so the
+    pymongo calls below yield to other signaling events while waiting on I/O.
+    """
+    
+    # Start the writer once per process, even if handlers are registered again
+    global _call_db_writer_started
+    if not _call_db_writer_started:
+        _call_db_writer_started = True
+        socketio.start_background_task(call_db_writer)
     
     @socketio.on('call_initiate')
-    def handle_call_initiate(data):
+    @authed
+    def handle_call_initiate(user, data):
         """Handle call initiation"""
-        print(f"===== WEBSOCKET: Call Initiate Event Received =====")
-        print(f"Data received: {data}")
+        logger.debug("Call initiate event received: %s", data)
         
         try:
-            user = get_user_from_token()
-            print(f"User from token: {user}")
-            
-            if not user:
-                print("ERROR: Authentication failed - no user found")
-                emit('call_error', {'message': 'Authentication required'})
-                return
-            
             callee_id = data.get('callee_id')
             call_type = data.get('call_type', 'voice')
             
-            print(f"Caller ID: {str(user['_id'])}, Callee ID: {callee_id}, Call Type: {call_type}")
+            logger.debug("Caller ID: %s, Callee ID: %s, Call Type: %s", user['_id'], callee_id, call_type)
             
             if not callee_id:
-                print("ERROR: No callee ID provided")
                 emit('call_error', {'message': 'Callee ID is required'})
                 return
             
             # Check if callee exists and is online
-            callee = User.get_by_id(callee_id)
+            callee = User.get_public_by_id(callee_id)
             if not callee:
-                print(f"ERROR: Callee {callee_id} not found")
                 emit('call_error', {'message': 'User not found'})
                 return
             
-            print(f"Callee found: {callee.get('username')}")
-            
             # Check if either user is already in a call
             caller_id = str(user['_id'])
             if is_user_in_call(caller_id) or is_user_in_call(callee_id):
-                print(f"ERROR: User already in call - Caller: {is_user_in_call(caller_id)}, Callee: {is_user_in_call(callee_id)}")
                 emit('call_error', {'message': 'User is already in a call'})
                 return
             
-            # Create call session in database
-            call_session = Call.create_call_session(caller_id, callee_id, call_type)
+            # Create call session in database, already ringing
+            call_session = Call.create_call_session(caller_id, callee_id, call_type, status='ringing')
             call_id = str(call_session['_id'])
             
-            print(f"Call session created with ID: {call_id}")
-            
             # Create call room name
             call_room = f"call_{call_id}"
             
             # Store in active calls
-            active_calls[call_id] = {
-                'caller_id': caller_id,
-                'callee_id': callee_id,
-                'status': 'initiated',
-                'room_name': call_room,
-                'call_type': call_type
-            }
-            
-            print(f"Active calls now: {list(active_calls.keys())}")
+            call_info = CallSession(
+                caller_id=caller_id,
+                callee_id=callee_id,
+                status='ringing',
+                room_name=call_room,
+                call_type=call_type,
+                caller_room=f"user_{caller_id}",
+                callee_room=f"user_{callee_id}",
+                caller_info={
+                    'id': caller_id,
+                    'username': user.get('username'),
+                    'full_name': user.get('full_name'),
+                    'profile_picture': user.get('profile_picture')
+                },
+                callee_info={
+                    'id': callee_id,
+                    'username': callee.get('username'),
+                    'full_name': callee.get('full_name'),
+                    'profile_picture': callee.get('profile_picture')
+                }
+            )
+            active_calls.add(call_id, call_info)
             
             # Join caller to call room
             join_room(call_room)
-            print(f"Caller joined room: {call_room}")
-            
-            # Update call status to ringing
-            Call.update_call_status(call_id, 'ringing')
-            active_calls[call_id]['status'] = 'ringing'
             
             # Notify callee about incoming call
-            callee_room = f"user_{callee_id}"
-            print(f"Sending incoming_call to room: {callee_room}")
+            callee_room = call_info.callee_room
             
             # Check if callee is connected
-            from app.realtime.events import connected_users
-            callee_connected = callee_id in connected_users
-            print(f"DEBUG: Callee {callee_id} connected: {callee_connected}")
-            if callee_connected:
-                print(f"DEBUG: Callee session ID: {connected_users[callee_id]}")
-            else:
-                print(f"DEBUG: Callee {callee_id} is not in connected_users: {list(connected_users.keys())}")
+            logger.debug("Callee %s connected: %s", callee_id, callee_id in connected_users)
             
             emit('incoming_call', {
                 'call_id': call_id,
-                'caller': {
-                    'id': caller_id,
-                    'username': user.get('username'),
-                    'full_name': user.get('full_name'),
-                    'profile_picture': user.get('profile_picture')
-                },
+                'caller': call_info.caller_info,
                 'call_type': call_type
             }, room=callee_room)
             
-            print(f"DEBUG: incoming_call event emitted to room {callee_room}")
-            
             # Confirm call initiation to caller
             emit('call_initiated', {
                 'call_id': call_id,
                 'status': 'ringing',
-                'callee': {
-                    'id': callee_id,
-                    'username': callee.get('username'),
-                    'full_name': callee.get('full_name'),
-                    'profile_picture': callee.get('profile_picture')
-                }
+                'callee': call_info.callee_info
             })
             
-            print(f"Call initiated: {caller_id} -> {callee_id} (Call ID: {call_id})")
-            print("===== Call Initiate Event Completed Successfully =====")
+            logger.info("Call initiated: %s -> %s (Call ID: %s)", caller_id, callee_id, call_id)
             
-        except Exception as e:
-            print(f"Error initiating call: {e}")
-            import traceback
-            traceback.print_exc()
+        except Exception:
+            logger.exception("Failed to initiate call")
             emit('call_error', {'message': 'Failed to initiate call'})
 
     @socketio.on('call_answer')
-    def handle_call_answer(data):
+    @authed
+    def handle_call_answer(user, data):
         """Handle call answer"""
         try:
-            user = get_user_from_token()
-            if not user:
-                emit('call_error', {'message': 'Authentication required'})
-                return
-            
             call_id = data.get('call_id')
-            if not call_id or call_id not in active_calls:
+            call_info = active_calls.get(call_id) if call_id else None
+            if not call_info:
                 emit('call_error', {'message': 'Invalid call ID'})
                 return
             
-            call_info = active_calls[call_id]
             user_id = str(user['_id'])
             
             # Verify user is the callee
-            if user_id != call_info['callee_id']:
+            if user_id != call_info.callee_id:
                 emit('call_error', {'message': 'Unauthorized to answer this call'})
                 return
             
-            # Prevent duplicate answer handling
-            if call_info['status'] in ['answered', 'connected']:
-                print(f"Call {call_id} already answered, ignoring duplicate answer")
+            # Atomically move the call to answered; a retried answer finds it already moved
+            if not Call.mark_answered(call_id):
+                logger.debug("Call %s already answered, ignoring duplicate answer", call_id)
                 # Still send confirmation to avoid frontend hanging
                 emit('call_answer_confirmed', {'call_id': call_id})
                 return
             
-            # Update call status
-            Call.update_call_status(call_id, 'answered')
-            active_calls[call_id]['status'] = 'answered'
+            active_calls.set_status(call_id, 'answered')
             
             # Join callee to call room
-            call_room = call_info['room_name']
+            call_room = call_info.room_name
             join_room(call_room)
             
             # Notify caller that call was answered
-            emit('call_answered', {
-                'call_id': call_id,
-                'callee': {
-                    'id': user_id,
-                    'username': user.get('username'),
-                    'full_name': user.get('full_name')
-                }
-            }, room=f"user_{call_info['caller_id']}")
+            if is_user_connected(call_info.caller_id):
+                emit('call_answered', {
+                    'call_id': call_id,
+                    'callee': call_info.callee_info
+                }, room=call_info.caller_room)
             
             # Confirm to callee
             emit('call_answer_confirmed', {'call_id': call_id})
             
-            print(f"Call answered: {call_id}")
+            logger.info("Call answered: %s", call_id)
             
         except Exception as e:
-            print(f"Error answering call: {e}")
+            logger.error("Error answering call: %s", e)
             emit('call_error', {'message': 'Failed to answer call'})
 
     @socketio.on('call_decline')
-    def handle_call_decline(data):
+    @authed
+    def handle_call_decline(user, data):
         """Handle call decline"""
         try:
-            user = get_user_from_token()
-            if not user:
-                emit('call_error', {'message': 'Authentication required'})
-                return
-            
             call_id = data.get('call_id')
             if not call_id:
                 emit('call_error', {'message': 'Call ID is required'})
                 return
                 
-            if call_id not in active_calls:
+            call_info = active_calls.get(call_id)
+            if not call_info:
                 emit('call_error', {'message': 'Invalid call ID'})
                 return
             
-            call_info = active_calls[call_id]
             user_id = str(user['_id'])
             
             # Verify user is the callee
-            if user_id != call_info['callee_id']:
+            if user_id != call_info.callee_id:
                 emit('call_error', {'message': 'Unauthorized to decline this call'})
                 return
             
             # Update call status in database
-            try:
-                Call.update_call_status(call_id, 'declined')
-            except Exception as db_error:
-                print(f"Error updating call status in database: {db_error}")
+            queue_call_status(call_id, 'declined')
             
             # Notify caller that call was declined
-            emit('call_declined', {'call_id': call_id}, room=f"user_{call_info['caller_id']}")
+            if is_user_connected(call_info.caller_id):
+                emit('call_declined', {'call_id': call_id}, room=call_info.caller_room)
             
             # Confirm to callee
             emit('call_decline_confirmed', {'call_id': call_id})
@@ -248,50 +297,46 @@ def register_handlers(socketio):
             # Clean up call session
             cleanup_call_session(call_id)
             
-            print(f"Call declined: {call_id}")
+            logger.info("Call declined: %s", call_id)
             
         except Exception as e:
-            print(f"Error declining call: {e}")
+            logger.error("Error declining call: %s", e)
             emit('call_error', {'message': 'Failed to decline call'})
 
     @socketio.on('call_end')
-    def handle_call_end(data):
+    @authed
+    def handle_call_end(user, data):
         """Handle call end"""
         try:
-            user = get_user_from_token()
-            if not user:
-                emit('call_error', {'message': 'Authentication required'})
-                return
-            
             call_id = data.get('call_id')
             if not call_id:
                 emit('call_error', {'message': 'Call ID is required'})
                 return
             
             # Check if call exists in active calls
-            if call_id not in active_calls:
+            call_info = active_calls.get(call_id)
+            if not call_info:
                 # Call might have already ended, just confirm
                 emit('call_end_confirmed', {'call_id': call_id})
                 return
             
-            call_info = active_calls[call_id]
             user_id = str(user['_id'])
             
             # Verify user is part of this call
-            if user_id not in [call_info['caller_id'], call_info['callee_id']]:
+            if user_id not in [call_info.caller_id, call_info.callee_id]:
                 emit('call_error', {'message': 'Unauthorized to end this call'})
                 return
             
             # Update call status and end time in database
-            try:
-                Call.end_call(call_id)
-            except Exception as db_error:
-                print(f"Error updating call in database: {db_error}")
-                # Continue with cleanup even if database update fails
+            queue_call_status(call_id, 'ended')
             
             # Notify other participant that call ended
-            other_user_id = call_info['callee_id'] if user_id == call_info['caller_id'] else call_info['caller_id']
-            emit('call_ended', {'call_id': call_id}, room=f"user_{other_user_id}")
+            if user_id == call_info.caller_id:
+                other_user_id, other_room = call_info.callee_id, call_info.callee_room
+            else:
+                other_user_id, other_room = call_info.caller_id, call_info.caller_room
+            if is_user_connected(other_user_id):
+                emit('call_ended', {'call_id': call_id}, room=other_room)
             
             # Confirm to the user who ended the call
             emit('call_end_confirmed', {'call_id': call_id})
@@ -299,195 +344,197 @@ def register_handlers(socketio):
             # Clean up call session
             cleanup_call_session(call_id)
             
-            print(f"Call ended: {call_id} by user {user_id}")
+            logger.info("Call ended: %s by user %s", call_id, user_id)
             
         except Exception as e:
-            print(f"Error ending call: {e}")
+            logger.error("Error ending call: %s", e)
             emit('call_error', {'message': 'Failed to end call'})
 
     @socketio.on('webrtc_offer')
-    def handle_webrtc_offer(data):
+    @authed
+    def handle_webrtc_offer(user, data):
         """Handle WebRTC offer for call establishment"""
         try:
-            user = get_user_from_token()
-            if not user:
-                emit('call_error', {'message': 'Authentication required'})
-                return
-            
             call_id = data.get('call_id')
             offer = data.get('offer')
             
-            if not call_id or call_id not in active_calls:
+            call_info = active_calls.get(call_id) if call_id else None
+            if not call_info:
                 emit('call_error', {'message': 'Invalid call ID'})
                 return
             
-            call_info = active_calls[call_id]
             user_id = str(user['_id'])
             
             # Verify user is the caller
-            if user_id != call_info['caller_id']:
+            if user_id != call_info.caller_id:
                 emit('call_error', {'message': 'Only caller can send offer'})
                 return
             
-            # Forward offer to callee
+            # Forward offer to callee; nothing to encode if they are gone
+            if not is_user_connected(call_info.callee_id):
+                return
+            
             emit('webrtc_offer', {
                 'call_id': call_id,
                 'offer': offer
-            }, room=f"user_{call_info['callee_id']}")
+            }, room=call_info.callee_room)
             
-            print(f"WebRTC offer forwarded for call: {call_id}")
+            logger.debug("WebRTC offer forwarded for call: %s", call_id)
             
         except Exception as e:
-            print(f"Error handling WebRTC offer: {e}")
+            logger.error("Error handling WebRTC offer: %s", e)
             emit('call_error', {'message': 'Failed to process WebRTC offer'})
 
     @socketio.on('webrtc_answer')
-    def handle_webrtc_answer(data):
+    @authed
+    def handle_webrtc_answer(user, data):
         """Handle WebRTC answer for call establishment"""
         try:
-            user = get_user_from_token()
-            if not user:
-                emit('call_error', {'message': 'Authentication required'})
-                return
-            
             call_id = data.get('call_id')
             answer = data.get('answer')
             
-            if not call_id or call_id not in active_calls:
+            call_info = active_calls.get(call_id) if call_id else None
+            if not call_info:
                 emit('call_error', {'message': 'Invalid call ID'})
                 return
             
-            call_info = active_calls[call_id]
             user_id = str(user['_id'])
             
             # Verify user is the callee
-            if user_id != call_info['callee_id']:
+            if user_id != call_info.callee_id:
                 emit('call_error', {'message': 'Only callee can send answer'})
                 return
             
             # Update call status to connected
-            Call.update_call_status(call_id, 'connected')
-            active_calls[call_id]['status'] = 'connected'
+            queue_call_status(call_id, 'connected')
+            active_calls.set_status(call_id, 'connected')
+            
+            # Forward answer to caller; nothing to encode if they are gone
+            if not is_user_connected(call_info.caller_id):
+                return
             
-            # Forward answer to caller
             emit('webrtc_answer', {
                 'call_id': call_id,
                 'answer': answer
-            }, room=f"user_{call_info['caller_id']}")
+            }, room=call_info.caller_room)
             
-            print(f"WebRTC answer forwarded for call: {call_id}")
+            logger.debug("WebRTC answer forwarded for call: %s", call_id)
             
         except Exception as e:
-            print(f"Error handling WebRTC answer: {e}")
+            logger.error("Error handling WebRTC answer: %s", e)
             emit('call_error', {'message': 'Failed to process WebRTC answer'})
 
     @socketio.on('webrtc_ice_candidate')
-    def handle_ice_candidate(data):
+    @authed
+    def handle_ice_candidate(user, data):
         """Handle ICE candidate exchange for WebRTC"""
         try:
-            user = get_user_from_token()
-            if not user:
-                emit('call_error', {'message': 'Authentication required'})
-                return
-            
             call_id = data.get('call_id')
             candidate = data.get('candidate')
             
-            if not call_id or call_id not in active_calls:
+            call_info = active_calls.get(call_id) if call_id else None
+            if not call_info:
                 emit('call_error', {'message': 'Invalid call ID'})
                 return
             
-            call_info = active_calls[call_id]
             user_id = str(user['_id'])
             
             # Verify user is part of this call
-            if user_id not in [call_info['caller_id'], call_info['callee_id']]:
+            if user_id not in [call_info.caller_id, call_info.callee_id]:
                 emit('call_error', {'message': 'Unauthorized to send ICE candidate'})
                 return
             
             # Forward ICE candidate to the other participant
-            other_user_id = call_info['callee_id'] if user_id == call_info['caller_id'] else call_info['caller_id']
+            if user_id == call_info.caller_id:
+                other_user_id, other_room = call_info.callee_id, call_info.callee_room
+            else:
+                other_user_id, other_room = call_info.caller_id, call_info.caller_room
+            if not is_user_connected(other_user_id):
+                return
+            
             emit('webrtc_ice_candidate', {
                 'call_id': call_id,
                 'candidate': candidate
-            }, room=f"user_{other_user_id}")
+            }, room=other_room)
             
-            print(f"ICE candidate forwarded for call: {call_id}")
+            logger.debug("ICE candidate forwarded for call: %s", call_id)
             
         except Exception as e:
-            print(f"Error handling ICE candidate: {e}")
+            logger.error("Error handling ICE candidate: %s", e)
             emit('call_error', {'message': 'Failed to process ICE candidate'})
 
-    @socketio.on('disconnect')
-    def handle_disconnect():
-        """Handle user disconnection - clean up any active calls"""
-        try:
-            user = get_user_from_token()
-            if user:
-                user_id = str(user['_id'])
-                cleanup_user_calls(user_id)
-                print(f"Cleaned up calls for disconnected user: {user_id}")
-        except Exception as e:
-            print(f"Error cleaning up calls on disconnect: {e}")
+def handle_session_disconnect():
+    """Clean up the calls of a disconnecting socket; called from the disconnect handler in events.py"""
+    try:
+        user = get_user_from_token()
+        sid_user_cache.pop(request.sid, None)
+        sid_rejected.discard(request.sid)
+        if user:
+            user_id = str(user['_id'])
+            cleanup_user_calls(user_id)
+            logger.debug("Cleaned up calls for disconnected user: %s", user_id)
+    except Exception as e:
+        logger.error("Error cleaning up calls on disconnect: %s", e)
+
+def is_user_connected(user_id):
+    """Check if a user may have a live socket to deliver to"""
+    # connected_users only covers this process; with a shared store the user may be on another worker
+    if isinstance(active_calls, RedisCallStore):
+        return True
+    
+    return user_id in connected_users
 
 def is_user_in_call(user_id):
     """Check if a user is currently in any active call"""
-    try:
-        for call_info in active_calls.values():
-            if user_id in [call_info['caller_id'], call_info['callee_id']]:
-                return True
-        return False
-    except Exception as e:
-        print(f"Error checking if user {user_id} is in call: {e}")
-        return False
+    return active_calls.call_for_user(user_id) is not None
 
 def cleanup_call_session(call_id):
-    """Clean up call session from memory and update database"""
+    """Clean up call session from the call store"""
     try:
-        if call_id in active_calls:
-            call_info = active_calls[call_id]
-            print(f"Cleaning up call session: {call_id} (caller: {call_info['caller_id']}, callee: {call_info['callee_id']})")
-            del active_calls[call_id]
+        call_info = active_calls.remove(call_id)
+        if call_info:
+            logger.debug("Cleaned up call session: %s (caller: %s, callee: %s)", call_id, call_info.caller_id, call_info.callee_id)
         else:
-            print(f"Call session {call_id} not found in active calls")
-        
-        print(f"Active calls remaining: {len(active_calls)}")
+            logger.debug("Call session %s not found in active calls", call_id)
     except Exception as e:
-        print(f"Error cleaning up call session {call_id}: {e}")
+        logger.error("Error cleaning up call session %s: %s", call_id, e)
 
 def cleanup_user_calls(user_id):
     """Clean up all calls for a specific user (when they disconnect)"""
     try:
-        calls_to_cleanup = []
-        for call_id, call_info in active_calls.items():
-            if user_id in [call_info['caller_id'], call_info['callee_id']]:
-                calls_to_cleanup.append(call_id)
+        call_id = active_calls.call_for_user(user_id)
+        calls_to_cleanup = [call_id] if call_id else []
         
         for call_id in calls_to_cleanup:
             try:
                 # End the call in database
-                Call.end_call(call_id)
+                queue_call_status(call_id, 'ended')
                 
                 # Get call info before cleanup
                 call_info = active_calls.get(call_id)
                 if call_info:
+                    if user_id == call_info.caller_id:
+                        other_user_id, other_room = call_info.callee_id, call_info.callee_room
+                    else:
+                        other_user_id, other_room = call_info.caller_id, call_info.caller_room
+                
+                if call_info and is_user_connected(other_user_id):
                     # Notify other participant
-                    other_user_id = call_info['callee_id'] if user_id == call_info['caller_id'] else call_info['caller_id']
-                    emit('call_ended', {
+                    # Broadcast through the server: the disconnecting socket's context is going away
+                    socketio.emit('call_ended', {
                         'call_id': call_id,
                         'reason': 'participant_disconnected'
-                    }, room=f"user_{other_user_id}")
+                    }, to=other_room)
                 
-                # Clean up from memory
+                # Clean up from the call store
                 cleanup_call_session(call_id)
                 
             except Exception as call_error:
-                print(f"Error cleaning up individual call {call_id}: {call_error}")
+                logger.error("Error cleaning up individual call %s: %s", call_id, call_error)
                 # Still try to remove from active calls
-                if call_id in active_calls:
-                    del active_calls[call_id]
+                active_calls.remove(call_id)
             
-        print(f"Cleaned up {len(calls_to_cleanup)} calls for user {user_id}")
+        logger.debug("Cleaned up %d calls for user %s", len(calls_to_cleanup), user_id)
         
     except Exception as e:
-        print(f"Error cleaning up calls for user {user_id}: {e}") 
\ No newline at end of file
+        logger.error("Error cleaning up calls for user %s: %s", user_id, e)
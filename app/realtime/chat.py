@@ -1,224 +1,424 @@
 from flask_socketio import emit, join_room, leave_room
-from flask_jwt_extended import decode_token
-from flask import current_app
+from flask import current_app, request
+from app.realtime import join_rooms, room_has_listeners
+from app.realtime._attach import resolve_attachment
 from app.models.message import Message  
 from app.models.user import User  
-from app.models.file import File  
-from app.models.media import Media  
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import datetime
+from datetime import timezone
+import functools
+import hashlib
 import jwt
 import logging
 import os
+import queue
+import threading
+import time
+
+try:
+    import orjson
+except ImportError:  # token claims are parsed with the stdlib json module instead
+    orjson = None
 
 
 DEBUG_MODE = os.environ.get('FLASK_ENV') == 'development'
 
 
-logging.basicConfig(level=logging.DEBUG if DEBUG_MODE else logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Decoded tokens keyed by a digest of the raw token: key -> (decoded_token, cached_until)
+_token_cache = OrderedDict()
+_token_cache_lock = threading.Lock()
+
+# Decoded tokens are reused for this many seconds (never past their exp claim).
+# Keys digest the whole token, not just its signature segment, so a cached
+# verification can never vouch for a different header or payload.
+TOKEN_CACHE_TTL = int(os.environ.get('TOKEN_CACHE_TTL', 300))
+TOKEN_CACHE_SIZE = 50000
+
+# Signing key and algorithms for chat tokens, read from the app config on first use
+_jwt_key = None
+_jwt_algorithms = None
+
+def _jwt_settings():
+    """Resolve the JWT signing key and algorithm once instead of per decode"""
+    global _jwt_key, _jwt_algorithms
+    if _jwt_key is None:
+        _jwt_algorithms = [current_app.config.get('JWT_ALGORITHM', 'HS256')]
+        _jwt_key = current_app.config['JWT_SECRET_KEY']
+    return _jwt_key, _jwt_algorithms
+
+class OrjsonPyJWT(jwt.PyJWT):
+    """PyJWT decoder that parses the claims segment with orjson
+    
+    Overrides PyJWT's _decode_payload(self, decoded) subclass hook; requirements.txt
+    pins PyJWT to the releases that have it with this signature.
+    """
+    
+    def _decode_payload(self, decoded):
+        try:
+            payload = orjson.loads(decoded['payload'])
+        except orjson.JSONDecodeError as e:
+            raise jwt.DecodeError(f"Invalid payload string: {e}") from e
+        if not isinstance(payload, dict):
+            raise jwt.DecodeError("Invalid payload string: must be a json object")
+        return payload
+
+_jwt_decoder = OrjsonPyJWT() if orjson is not None else jwt.PyJWT()
+
+def _decode_chat_token(token):
+    """Verify a token with PyJWT directly; chat handlers only need its sub and exp claims
+    
+    Skips flask_jwt_extended's per-call config lookups and callbacks; tokens are
+    still issued (and verified on HTTP routes) by flask_jwt_extended.
+    """
+    key, algorithms = _jwt_settings()
+    return _jwt_decoder.decode(token, key, algorithms=algorithms, options={'require': ['sub', 'exp']})
+
 def validate_token(token):
     """Validate JWT token and return the decoded token or None if invalid"""
     if not token:
         return None
+    
+    # Clients resend the same token with every event; only verify it once in a while
+    key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    now = time.time()
+    cached = _token_cache.get(key)
+    if cached:
+        if cached[1] > now:
+            return cached[0]
+        with _token_cache_lock:
+            _token_cache.pop(key, None)
+    
     try:
-        decoded_token = decode_token(token)
-        return decoded_token
+        decoded_token = _decode_chat_token(token)
     except Exception:  
         return None
+    
+    exp = decoded_token.get('exp')
+    cached_until = min(now + TOKEN_CACHE_TTL, exp) if exp else now + TOKEN_CACHE_TTL
+    with _token_cache_lock:
+        _token_cache[key] = (decoded_token, cached_until)
+        if len(_token_cache) > TOKEN_CACHE_SIZE:
+            _token_cache.popitem(last=False)
+    return decoded_token
 
-def register_handlers(socketio):
-    """Register all Socket.IO event handlers for chat"""
+# Direct chat room per socket session and recipient: sid -> {recipient: room}
+_room_cache = {}
+
+def forget_session_rooms(sid):
+    """Drop the cached direct-chat rooms of a disconnected socket session"""
+    _room_cache.pop(sid, None)
+
+@functools.lru_cache(maxsize=100000)
+def _room_for(a, b):
+    """Deterministic room name for a pair of users, built once per pair"""
+    # User IDs are 24-char lowercase hex ObjectIds, for which the plain string
+    # comparison (a C memcmp on ASCII strings) already orders them numerically;
+    # converting to int first would cost more than it saves
+    return f"{a}_{b}" if a < b else f"{b}_{a}"
+
+def _session_room(user_id, recipient):
+    """Room of a direct chat for the current socket session, computed once per recipient"""
+    rooms = _room_cache.setdefault(request.sid, {})
+    room = rooms.get(recipient)
+    if room is None:
+        room = rooms[recipient] = _room_for(user_id, recipient)
+    return room
+
+# Fixed payloads are built once and shared; emit serializes them without mutating
+_ERR_INVALID_TOKEN = {'message': 'Invalid or missing token'}
+_ERR_INVALID_RECIPIENT = {'message': 'Invalid recipient'}
+_ERR_RECIPIENTS_NOT_LIST = {'message': 'recipients must be a list'}
+_JOINED_TEMPLATE = 'User joined room %s'
+_LEFT_TEMPLATE = 'User left room %s'
+
+# Stand-in user for tokenless joins in development
+DEBUG_TEST_USER_ID = "test_user_123"
+
+def authenticated_room(handler=None, allow_debug_user=False):
+    """Validate the event's token and resolve its direct-chat room, calling handler(data, sub, room)
     
-    # Connect and disconnect events are handled in events.py
-    # Do not add them here to avoid conflicts
+    With allow_debug_user, development mode lets tokenless events through as DEBUG_TEST_USER_ID.
+    """
+    if handler is None:
+        return functools.partial(authenticated_room, allow_debug_user=allow_debug_user)
     
-    @socketio.on('join')
-    def handle_join(data):
-        """Handle a user joining a chat room."""
-        print("\n========== WEBSOCKET: JOIN REQUEST ==========")
-        print(f"Data received: {data}")
+    @functools.wraps(handler)
+    def wrapper(data):
+        logger.debug("%s data=%r", handler.__name__, data)
+        decoded_token = validate_token(data.get('token'))
+        if decoded_token:
+            sub = decoded_token['sub']
+            return handler(data, sub, _session_room(sub, data['recipient']))
         
-        token = data.get('token')
-        decoded_token = validate_token(token)
+        logger.warning("%s rejected: invalid or missing token", handler.__name__)
+        if allow_debug_user and DEBUG_MODE:
+            logger.debug("DEBUG MODE: allowing %s without token for testing", handler.__name__)
+            return handler(data, DEBUG_TEST_USER_ID, _room_for(DEBUG_TEST_USER_ID, data['recipient']))
         
-        if not decoded_token:
-            print("ERROR: Invalid or missing token")
-            
-           
-            if DEBUG_MODE:
-                print("DEBUG MODE: Allowing connection without token for testing")
-                
-                test_user_id = "test_user_123"
-                room = f"{min(test_user_id, data['recipient'])}_{max(test_user_id, data['recipient'])}"
-                join_room(room)
-                print(f"DEBUG MODE: User {test_user_id} joined room {room}")
-                emit('status', {'message': f'User joined room {room}'}, room=room)
-                return
-            
-            emit('error', {'message': 'Invalid or missing token'})
-            return
+        emit('error', _ERR_INVALID_TOKEN)
+    return wrapper
 
-        room = f"{min(decoded_token['sub'], data['recipient'])}_{max(decoded_token['sub'], data['recipient'])}"
-        join_room(room)
-        print(f"SUCCESS: User {decoded_token['sub']} joined room {room}")
-        emit('status', {'message': f'User joined room {room}'}, room=room)
+# Built messages waiting to be saved by message_writer: (message, sender sid, client_markers)
+message_write_queue = queue.Queue()
 
-    @socketio.on('leave')
-    def handle_leave(data):
-        """Handle a user leaving a chat room."""
-        print("\n========== WEBSOCKET: LEAVE REQUEST ==========")
-        print(f"Data received: {data}")
-        
-        token = data.get('token')
-        decoded_token = validate_token(token)
-        if not decoded_token:
-            print("ERROR: Invalid or missing token")
-            emit('error', {'message': 'Invalid or missing token'})
-            return
+# Queued messages are saved together after this long (seconds) or once this many are pending
+MESSAGE_FLUSH_INTERVAL = float(os.environ.get('MESSAGE_FLUSH_INTERVAL', 0.02))
+MESSAGE_BATCH_SIZE = int(os.environ.get('MESSAGE_BATCH_SIZE', 500))
 
-        room = f"{min(decoded_token['sub'], data['recipient'])}_{max(decoded_token['sub'], data['recipient'])}"
-        leave_room(room)
-        print(f"SUCCESS: User {decoded_token['sub']} left room {room}")
-        emit('status', {'message': f'User left room {room}'}, room=room)
+# A batch that fails to save is retried this many times before its senders are told
+MESSAGE_WRITE_ATTEMPTS = 3
 
-    @socketio.on('send_message')
-    def handle_send_message(data):
-        """Handle sending a message."""
-        print("\n========== WEBSOCKET: NEW MESSAGE RECEIVED ==========")
-        print(f"Raw message data from client: {data}") 
-        
-        client_attachment_payload = data.get('attachment')
-        if client_attachment_payload:
-            print(f"Client attachment payload received: {client_attachment_payload}")
-            print(f"Keys in client_attachment_payload: {list(client_attachment_payload.keys()) if isinstance(client_attachment_payload, dict) else 'Not a dict'}")
+# MongoDB's duplicate key error: the message was saved by an earlier attempt
+DUPLICATE_KEY_ERROR = 11000
 
-        token = data.get('token')
-        decoded_token = validate_token(token)
-        if not decoded_token:
-            print("ERROR: Invalid or missing token")
-            emit('error', {'message': 'Invalid or missing token'})
+def save_message_batch(socketio, batch):
+    """Save queued (message, sid, client_markers) entries, retrying the ones that fail
+    
+    Senders were acked (and recipients sent the message) before the save, so whatever
+    still fails after the last attempt is reported to the sending socket.
+    """
+    pending = batch
+    for attempt in range(1, MESSAGE_WRITE_ATTEMPTS + 1):
+        try:
+            Message.insert_many([message for message, _, _ in pending])
             return
+        except BulkWriteError as e:
+            # The write is unordered: only the listed documents failed
+            failed = {error['index'] for error in e.details.get('writeErrors', [])
+                      if error.get('code') != DUPLICATE_KEY_ERROR}
+            pending = [entry for index, entry in enumerate(pending) if index in failed]
+            if not pending:
+                return
+            logger.warning("Failed to save %d messages (attempt %d): %s", len(pending), attempt, e)
+        except Exception:
+            logger.exception("Failed to save %d messages (attempt %d)", len(pending), attempt)
+        if attempt < MESSAGE_WRITE_ATTEMPTS:
+            socketio.sleep(0.1 * attempt)
+    
+    logger.error("Giving up on %d messages", len(pending))
+    for message, sid, client_markers in pending:
+        socketio.emit('message_failed', {
+            'message': 'Failed to save message',
+            'message_id': str(message['_id']),
+            **client_markers
+        }, to=sid)
+
+def message_writer(socketio):
+    """Save queued chat messages in bulk, off the send_message path"""
+    while True:
+        batch = [message_write_queue.get()]
+        deadline = time.monotonic() + MESSAGE_FLUSH_INTERVAL
+        
+        while len(batch) < MESSAGE_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(message_write_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        
+        save_message_batch(socketio, batch)
+
+# Runs the sender lookup of a message concurrently with its attachment resolution and build
+# (green threads under eventlet's monkey patching)
+_lookup_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix='chat-lookup')
 
-        print(f"Token validated for user: {decoded_token['sub']}")
+# Broadcasts to the same room within this window go out as one receive_batch frame
+ROOM_BATCH_WINDOW = 0.005
 
-        room = f"{min(decoded_token['sub'], data['recipient'])}_{max(decoded_token['sub'], data['recipient'])}"
-        print(f"Message room: {room}")
+# Payloads waiting for their room's flush: (room, sender sid) -> [message_payload, ...]
+_room_outbox = {}
+_room_outbox_lock = threading.Lock()
+
+# Set once message_writer is running
+_message_writer_started = False
+
+def register_handlers(socketio):
+    """Register all Socket.IO event handlers for chat"""
+    
+    # Start the writer once per process, even if handlers are registered again
+    global _message_writer_started
+    if not _message_writer_started:
+        _message_writer_started = True
+        socketio.start_background_task(message_writer, socketio)
+    
+    def flush_room(room, sender_sid):
+        """Send everything a socket queued for a room once the batch window has passed"""
+        socketio.sleep(ROOM_BATCH_WINDOW)
+        with _room_outbox_lock:
+            batch = _room_outbox.pop((room, sender_sid), [])
+        # The sending socket already rendered its messages; its other devices are in the room too
+        if len(batch) == 1:
+            # A lone message keeps the plain event
+            socketio.emit('receive_message', batch[0], to=room, skip_sid=sender_sid)
+        elif batch:
+            socketio.emit('receive_batch', batch, to=room, skip_sid=sender_sid)
+    
+    def queue_room_message(room, message_payload, sender_sid):
+        """Queue a message for its room, starting a flush if none is pending"""
+        key = (room, sender_sid)
+        with _room_outbox_lock:
+            pending = _room_outbox.get(key)
+            if pending is not None:
+                pending.append(message_payload)
+                return
+            _room_outbox[key] = [message_payload]
+        socketio.start_background_task(flush_room, room, sender_sid)
+    
+    # Connect and disconnect events are handled in events.py
+    # Do not add them here to avoid conflicts
+    
+    def persist_and_broadcast(sid, room, message_id, created_at, message_id_str, timestamp,
+                              sender_id, recipient_id, content, message_type, attachment_payload,
+                              client_markers):
+        """Resolve the attachment, build and queue the message for saving, then broadcast it
         
-        sender_id = decoded_token['sub']
-        recipient_id = data['recipient']
-        content = data.get('content', '')
-        message_type = data.get('message_type', 'text')
+        The sender was acked before any of this ran, so a failure is reported with the
+        message id and the client's own markers to let it flag the optimistic message.
+        """
+        # An offline recipient reads the message from history; only the save is needed then
+        broadcast = room_has_listeners(room, sid)
         
-        attachment_to_save = None # Renamed from 'attachment' to avoid confusion
+        # The sender lookup doesn't depend on the attachment or the build; run it alongside them
+        sender_future = _lookup_pool.submit(User.get_sender_profile, sender_id) if broadcast else None
         
-        if client_attachment_payload and isinstance(client_attachment_payload, dict):
-           
-            media_doc_id = client_attachment_payload.get('fileId') 
-            
+        attachment = None
+        if attachment_payload:
+            attachment, message_type = resolve_attachment(attachment_payload, sender_id, message_type, content)
+            logger.debug("attachment=%r message_type=%s", attachment, message_type)
         
-            if not media_doc_id:
-                media_doc_id = client_attachment_payload.get('file_id')
-
-            original_filename = client_attachment_payload.get('filename')
-            
-            resolved_file_type = client_attachment_payload.get('type') or client_attachment_payload.get('file_type') or 'document' 
-
-            print(f"Processing client attachment: media_doc_id='{media_doc_id}', filename='{original_filename}', type='{resolved_file_type}'")
-
-            file_info = None
-            if media_doc_id and media_doc_id not in ['undefined', 'null', None, '']:
-                print(f"Attempting to fetch Media/File object using ID: {media_doc_id} (type hint: {resolved_file_type})")
-                if resolved_file_type in ('image', 'video', 'audio'):
-                    file_info = Media.get_by_id(media_doc_id)
-                else:
-                    file_info = File.get_by_id(media_doc_id)
-                
-                if file_info:
-                    print(f"Successfully fetched by ID: {file_info['_id']}")
-                else:
-                    # If ID lookup fails, maybe it was a filename passed as fileId by mistake, or bad ID
-                    print(f"WARN: Could not find Media/File for ID: {media_doc_id}. Will try filename lookup if available.")
-            
-            # If file_info not found by ID, AND we have an original_filename, try by filename
-            if not file_info and original_filename:
-                print(f"Attempting to fetch by filename: '{original_filename}' for user '{sender_id}' (type hint: {resolved_file_type})")
-                if resolved_file_type in ('image', 'video', 'audio'):
-                    file_info = Media.get_most_recent_by_user_and_filename(sender_id, original_filename)
-                else:
-                    file_info = File.get_most_recent_by_user_and_filename(sender_id, original_filename)
-                
-                if file_info:
-                    print(f"Successfully fetched by filename: {file_info['_id']}")
-                else:
-                    print(f"WARN: Could not find Media/File by filename: {original_filename}")
-
-            if file_info:
-                # Determine the most reliable message_type from the retrieved file_info
-                message_type = file_info.get('media_type') or file_info.get('file_type') or resolved_file_type
-                attachment_to_save = {
-                    "file_id": str(file_info['_id']),
-                    "file_type": message_type,
-                    "filename": file_info.get('original_filename', original_filename or ''),
-                    "mime_type": file_info.get('mime_type', ''),
-                    "size": file_info.get('file_size', 0)
-                }
-            else:
-                print(f"ERROR: Attachment processing failed. No file_info found for: {client_attachment_payload}")
-                # Keep original message_type if attachment fails, or reset if it was file-specific
-                if message_type not in ['text'] and not content: # If it was e.g. 'video' but no content and attach failed
-                    message_type = 'text' # Default to text if attachment fails and no content
-        
-        print(f"Final attachment to save in DB: {attachment_to_save}")
-        print(f"Final message_type for DB: {message_type}")
-
         try:
-            print(f"Creating message in database...")
-            message = Message.create(
+            message = Message.build(
                 sender_id=sender_id,
                 recipient_id=recipient_id,
                 content=content,
                 message_type=message_type,
-                attachment=attachment_to_save # Use the processed attachment_to_save
+                attachment=attachment,
+                message_id=message_id,
+                created_at=created_at
             )
-            print(f"Message created successfully with ID: {message['_id']}")
         except Exception as e:
-            print(f"ERROR: Failed to save message to database - {str(e)}")
-            emit('error', {'message': 'Failed to save message'})
+            logger.error("Failed to build message: %s", e)
+            socketio.emit('error', {'message': 'Failed to save message', 'message_id': message_id_str,
+                                    **client_markers}, to=sid)
+            return
+        
+        message_write_queue.put((message, sid, client_markers))
+        
+        if not broadcast:
             return
 
         try:
-            # Fetch sender details from User model
-            sender = User.get_by_id(sender_id)
+            # Sender name/avatar, cached in the User model across messages
+            sender_name, sender_avatar = sender_future.result()
             
-            # Convert ObjectId and datetime objects to strings
+            # Built from the string forms already at hand: no ObjectId/datetime conversions
+            # (the packet itself is encoded by orjson when installed, see init_socketio)
             message_payload = {
-                'id': str(message['_id']),
-                'sender': str(message['sender_id']),
-                'sender_name': sender.get('username', ''),  # Use username as sender_name
-                'sender_avatar': sender.get('profile_picture', ''),  # Use profile_picture as sender_avatar
-                'recipient': str(message['recipient_id']),
-                'content': message['content'],
-                'timestamp': message['created_at'].isoformat(),
+                'id': message_id_str,
+                'sender': sender_id,
+                'sender_name': sender_name,
+                'sender_avatar': sender_avatar,
+                'recipient': recipient_id,
+                'content': content,
+                'timestamp': timestamp,
                 'status': message['status'],
-                'message_type': message['message_type'],
-                'attachment': message['attachment']
+                'message_type': message_type,
+                'attachment': attachment
             }
-            print(f"Broadcasting message to room {room}")
-            emit('receive_message', message_payload, room=room)
-            print(f"Message broadcast successful")
+            # Server-side emit (outside the sender's request context), batched per room.
+            # The packet is encoded once for the whole room (python-socketio>=5.9)
+            queue_room_message(room, message_payload, sid)
         except Exception as e:
-            print(f"ERROR: Failed to broadcast message - {str(e)}")
-            # Optionally notify sender of emission failure
-            pass
+            logger.error("Failed to broadcast message to %s: %s", room, e)
+    
+    @socketio.on('join')
+    @authenticated_room(allow_debug_user=True)
+    def handle_join(data, sub, room):
+        """Handle a user joining a chat room."""
+        join_room(room)
+        logger.info("user %s joined %s", sub, room)
+        emit('status', {'message': _JOINED_TEMPLATE % room}, room=room)
+
+    @socketio.on('join_rooms')
+    def handle_join_rooms(data):
+        """Handle a user opening several chats at once: one token check, many rooms."""
+        logger.debug("join_rooms data=%r", data)
+        
+        decoded_token = validate_token(data.get('token'))
+        if not decoded_token:
+            logger.warning("join_rooms rejected: invalid or missing token")
+            emit('error', _ERR_INVALID_TOKEN)
+            return
+        
+        recipients = data.get('recipients')
+        if not isinstance(recipients, list):
+            emit('error', _ERR_RECIPIENTS_NOT_LIST)
+            return
+        if not all(isinstance(recipient, str) and ObjectId.is_valid(recipient) for recipient in recipients):
+            emit('error', _ERR_INVALID_RECIPIENT)
+            return
+        
+        sub = decoded_token['sub']
+        rooms = [_session_room(sub, recipient) for recipient in recipients]
+        join_rooms(rooms)
+        logger.info("user %s joined %d rooms", sub, len(rooms))
+        emit('status', {'message': f'User joined {len(rooms)} rooms', 'rooms': rooms})
+
+    @socketio.on('leave')
+    @authenticated_room
+    def handle_leave(data, sub, room):
+        """Handle a user leaving a chat room."""
+        leave_room(room)
+        _room_cache.get(request.sid, {}).pop(data['recipient'], None)
+        logger.info("user %s left %s", sub, room)
+        emit('status', {'message': _LEFT_TEMPLATE % room}, room=room)
+
+    @socketio.on('send_message')
+    @authenticated_room
+    def handle_send_message(data, sender_id, room):
+        """Handle sending a message."""
+        recipient_id = data['recipient']
+        content = data.get('content', '')
+        message_type = data.get('message_type', 'text')
+        
+        # Most messages are text-only; they skip attachment handling (and its logging) entirely.
+        # Attachments are resolved in the background task, alongside the sender lookup
+        client_attachment_payload = data.get('attachment')
+        if client_attachment_payload and not isinstance(client_attachment_payload, dict):
+            logger.warning("ignoring attachment that is not an object: %r", client_attachment_payload)
+            client_attachment_payload = None
+
+        if not ObjectId.is_valid(recipient_id):
+            emit('error', _ERR_INVALID_RECIPIENT)
+            return
+        
+        # Echo the client's own markers so it can match the ack (or a later error) to its optimistic message
+        client_markers = {key: data[key] for key in ('client_msg_id', 'client_ts') if data.get(key)}
+        
+        # Hand out the id and timestamp now; building, saving and broadcasting happen in the background
+        message_id = ObjectId()
+        created_at = datetime.datetime.now(timezone.utc)
+        # Formatted once, shared by the ack and the broadcast
+        message_id_str = str(message_id)
+        timestamp = created_at.isoformat()
+        socketio.start_background_task(
+            persist_and_broadcast, request.sid, room, message_id, created_at, message_id_str, timestamp,
+            sender_id, recipient_id, content, message_type, client_attachment_payload, client_markers
+        )
         
         # Return acknowledgment to the sender
-        ack_payload = {
+        return {
             'status': 'success',
-            'message_id': str(message['_id']),
-            'timestamp': message['created_at'].isoformat()
+            'message_id': message_id_str,
+            'timestamp': timestamp,
+            **client_markers
         }
-        print(f"Sending acknowledgment to sender: {ack_payload}")
-        print("========== MESSAGE PROCESSING COMPLETE ==========\n")
-        return ack_payload
 
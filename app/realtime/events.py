@@ -1,137 +1,225 @@
 from flask import request
-from flask_socketio import emit, join_room, leave_room
-from flask_jwt_extended import decode_token
+from flask_socketio import emit
+from app.realtime import join_rooms, socketio
+from app.realtime.chat import forget_session_rooms, validate_token
+from app.models.group import Group
 from app.models.presence import Presence
 from app.models.user import User
 from app.utils.db import get_db
+from bson import ObjectId
+import logging
 import threading
-import time
+
+logger = logging.getLogger(__name__)
 
 # Store user_id to session_id mapping
 connected_users = {}
 
+# Reverse mapping, session_id to user_id, for O(1) lookups on disconnect/heartbeat
+sid_to_user = {}
+
+# Serializes writes to the two maps above; reads (membership checks, snapshots) stay lock-free
+_connected_users_lock = threading.Lock()
+
+# How often coalesced presence/typing updates are flushed, in seconds
+COALESCE_INTERVAL = 0.1
+
+# Pending coalesced emits: (event, room) -> {user_id: latest payload}
+_pending_emits = {}
+_pending_emits_lock = threading.Lock()
+
+def queue_coalesced_emit(event, payload, room):
+    """Queue a per-user update for a room; only the latest one per user is sent on flush"""
+    with _pending_emits_lock:
+        _pending_emits.setdefault((event, room), {})[payload['user_id']] = payload
+
+def contacts_room(user_id):
+    """Room joined by the sockets of everyone who has user_id as an accepted contact"""
+    return f"contacts_of_{user_id}"
+
+def sync_contact_rooms(user_id, contact_id):
+    """Join or leave the presence rooms between two users after their contact entries change
+    
+    Like handle_connect, each user's session on this worker watches the other's contacts
+    room only while their own entry for them is accepted.
+    """
+    user_id, contact_id = str(user_id), str(contact_id)
+    entries = get_db().contacts.find({
+        "$or": [
+            {"user_id": ObjectId(user_id), "contact_id": ObjectId(contact_id)},
+            {"user_id": ObjectId(contact_id), "contact_id": ObjectId(user_id)}
+        ],
+        "status": "accepted"
+    }, {"user_id": 1, "_id": 0})
+    watchers = {str(entry['user_id']) for entry in entries}
+    
+    for watcher, watched in ((user_id, contact_id), (contact_id, user_id)):
+        sid = connected_users.get(watcher)
+        if not sid:
+            continue
+        if watcher in watchers:
+            socketio.server.enter_room(sid, contacts_room(watched), namespace='/')
+        else:
+            socketio.server.leave_room(sid, contacts_room(watched), namespace='/')
+
+def group_room(group_id):
+    """Room joined by the sockets of every member of a group, for group broadcasts"""
+    # Separate from group_<id>, which clients join and leave as they open a group's chat
+    # Joined on each member's own worker, so with a message queue it spans all workers
+    return f"group_members_{group_id}"
+
+def notify_contacts_presence(user_id, username, status):
+    """Queue one presence_update to every online user who has user_id as an accepted contact"""
+    # Watchers joined the room on connect, so this needs no contacts query or per-contact emits
+    queue_coalesced_emit('presence_update', {
+        'user_id': user_id,
+        'username': username,
+        'status': status
+    }, room=contacts_room(user_id))
+
+# Set once the coalesced-emit flusher and presence heartbeat are running
+_background_tasks_started = False
+
 def register_handlers(socketio):
     """Register all Socket.IO event handlers for connection events"""
     
-    # Start a background thread for heartbeat
+    def coalesced_emit_flusher():
+        """Periodically send the latest queued presence/typing update per user and room"""
+        global _pending_emits
+        while True:
+            socketio.sleep(COALESCE_INTERVAL)
+            with _pending_emits_lock:
+                pending, _pending_emits = _pending_emits, {}
+            
+            for (event, room), updates in pending.items():
+                for payload in updates.values():
+                    socketio.emit(event, payload, to=room)
+    
+    # Start a background task for heartbeat
     def heartbeat_thread():
         """Periodically refresh presence status for all connected users"""
         while True:
-            time.sleep(60)  # Run every minute
+            socketio.sleep(60)  # Run every minute, yielding to the socket handlers meanwhile
             try:
-                # For each connected user, refresh their presence status
-                for user_id in list(connected_users.keys()):
-                    try:
-                        Presence.update_status(user_id, Presence.STATUS_ONLINE)
-                        print(f"Refreshed online status for user {user_id}")
-                    except Exception as e:
-                        print(f"Error refreshing presence for {user_id}: {str(e)}")
+                # Refresh the presence status of every connected user in one batch
+                user_ids = list(connected_users)  # one C-level copy, no Python code runs mid-iteration
+                refreshed = Presence.bulk_refresh(user_ids)
+                logger.debug("Refreshed online status for %d of %d connected users", refreshed, len(user_ids))
             except Exception as e:
-                print(f"Error in heartbeat thread: {str(e)}")
+                logger.error("Error in heartbeat thread: %s", e)
     
-    # Start the heartbeat thread
-    thread = threading.Thread(target=heartbeat_thread, daemon=True)
-    thread.start()
+    # Start the flusher and heartbeat once per process, even if handlers are registered again
+    global _background_tasks_started
+    if not _background_tasks_started:
+        _background_tasks_started = True
+        socketio.start_background_task(coalesced_emit_flusher)
+        socketio.start_background_task(heartbeat_thread)
     
     @socketio.on('connect')
     def handle_connect():
         """Handle client connection"""
-        print("\n========== WEBSOCKET: Client Connected ==========")
         token = request.args.get('token')
         if not token:
-            print("ERROR: No token provided for connection")
+            logger.warning("Connection rejected: no token provided")
             return False  # reject connection
         
         try:
-            # Decode token to get user_id
-            decoded = decode_token(token)
+            # Decode token to get user_id (shares the chat handlers' decoded-token cache)
+            decoded = validate_token(token)
+            if not decoded:
+                logger.warning("Connection rejected: invalid token")
+                return False
             user_id = decoded['sub']
-            print(f"SUCCESS: User {user_id} connected with token")
             
             # Store the session
-            connected_users[user_id] = request.sid
-            print(f"SUCCESS: Added user {user_id} to connected_users map")
+            with _connected_users_lock:
+                connected_users[user_id] = request.sid
+                sid_to_user[request.sid] = user_id
             
-            # Join a room specific to this user
-            join_room(f"user_{user_id}")
-            print(f"SUCCESS: User {user_id} joined their personal room")
+            # Join a room specific to this user, the presence rooms of their contacts,
+            # the member rooms of their groups, and rejoin the room of a call still in progress
+            rooms = [f"user_{user_id}"]
+            contacts = get_db().contacts.find(
+                {"user_id": ObjectId(user_id), "status": "accepted"}, {"contact_id": 1, "_id": 0}
+            )
+            rooms.extend(contacts_room(str(contact['contact_id'])) for contact in contacts)
+            rooms.extend(group_room(group_id) for group_id in Group.get_user_group_ids(user_id))
+            from app.realtime.calling import active_calls
+            call_id = active_calls.call_for_user(user_id)
+            if call_id:
+                rooms.append(f"call_{call_id}")
+            join_rooms(rooms)
+            logger.info("User %s connected, joined %d rooms", user_id, len(rooms))
             
             # Update user presence
             Presence.update_status(user_id, Presence.STATUS_ONLINE)
-            print(f"SUCCESS: User {user_id} status set to ONLINE in database")
             
-            # Get user data
-            user = User.get_by_id(user_id)
-            print(f"SUCCESS: Retrieved user data for {user_id}")
+            # Get user data (cached username, shared with chat broadcasts)
+            username, _ = User.get_sender_profile(user_id)
             
             # Log current presence state
-            print(f"PRESENCE DEBUG: Current connected_users: {list(connected_users.keys())}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Current connected_users: %s", list(connected_users))
             
             # Notify user's contacts about online status
-            db = get_db()
-            contacts = db.contacts.find({"contact_id": user_id, "status": "accepted"})
-            
-            for contact in contacts:
-                contact_id = str(contact['user_id'])  # Convert ObjectId to string
-                if contact_id in connected_users:
-                    emit('presence_update', {
-                        'user_id': str(user_id),  # Convert ObjectId to string
-                        'username': user['username'],
-                        'status': Presence.STATUS_ONLINE
-                    }, room=f"user_{contact_id}")
+            notify_contacts_presence(user_id, username, Presence.STATUS_ONLINE)
                     
             return True
         except Exception as e:
-            print(f"ERROR: WebSocket connection error: {str(e)}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("WebSocket connection error: %s", e)
             return False
 
+    # The only disconnect handler: Socket.IO keeps one handler per event, so the
+    # chat and calling cleanups run from here rather than registering their own
     @socketio.on('disconnect')
     def handle_disconnect():
         """Handle client disconnection"""
-        # Find user_id by session_id
-        user_id = None
-        for uid, sid in connected_users.items():
-            if sid == request.sid:
-                user_id = uid
-                break
+        # Decoded tokens are cached by token, not by session, so only the rooms need dropping
+        forget_session_rooms(request.sid)
         
-        if user_id:
-            # Remove from connected users
-            connected_users.pop(user_id, None)
-            
+        from app.realtime.calling import handle_session_disconnect
+        handle_session_disconnect()
+        
+        # Find user_id by session_id, and only drop the user if this was their
+        # current session (not an older, replaced one)
+        with _connected_users_lock:
+            user_id = sid_to_user.pop(request.sid, None)
+            went_offline = bool(user_id) and connected_users.get(user_id) == request.sid
+            if went_offline:
+                # Remove from connected users
+                del connected_users[user_id]
+        
+        if went_offline:
             # Update presence status
             Presence.update_status(user_id, Presence.STATUS_OFFLINE)
             
-            # Get user data
-            user = User.get_by_id(user_id)
+            # Get user data (cached username, shared with chat broadcasts)
+            username, _ = User.get_sender_profile(user_id)
             
             # Notify user's contacts about offline status
-            db = get_db()
-            contacts = db.contacts.find({"contact_id": user_id, "status": "accepted"})
-            
-            for contact in contacts:
-                contact_id = str(contact['user_id'])  # Convert ObjectId to string
-                if contact_id in connected_users:
-                    emit('presence_update', {
-                        'user_id': str(user_id),  # Convert ObjectId to string
-                        'username': user['username'],
-                        'status': Presence.STATUS_OFFLINE
-                    }, room=f"user_{contact_id}")
+            notify_contacts_presence(user_id, username, Presence.STATUS_OFFLINE)
+
+    @socketio.on('contact_updated')
+    def handle_contact_updated(data):
+        """Handle a contact request being accepted, or a contact removed, blocked or unblocked"""
+        decoded = validate_token(data.get('token'))
+        if not decoded:
+            emit('error', {'message': 'Invalid or missing token'})
+            return
+        
+        contact_id = data.get('contact_id')
+        if not isinstance(contact_id, str) or not ObjectId.is_valid(contact_id):
+            emit('error', {'message': 'Invalid contact'})
+            return
+        
+        # Presence updates start (or stop) flowing both ways without waiting for a reconnect
+        sync_contact_rooms(decoded['sub'], contact_id)
 
     @socketio.on('heartbeat')
     def handle_heartbeat(data=None):
         """Handle heartbeat from client to refresh presence"""
-        sid = request.sid
-        user_id = None
-        
         # Find the user ID for this session
-        for uid, session_id in connected_users.items():
-            if session_id == sid:
-                user_id = uid
-                break
-                
+        user_id = sid_to_user.get(request.sid)
         if user_id:
             # Refresh the user's online status
             Presence.update_status(user_id, Presence.STATUS_ONLINE)
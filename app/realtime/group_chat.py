@@ -1,29 +1,95 @@
+from flask import request
 from flask_socketio import emit, join_room, leave_room
-from flask_jwt_extended import decode_token
-from flask import current_app
+from app.realtime import join_rooms, room_has_listeners, socketio
+from app.realtime._attach import resolve_attachment
+from app.realtime.events import connected_users, group_room, sid_to_user
 from app.models.group import Group
 from app.models.user import User
 from app.models.group_message import GroupMessage
-from app.realtime.events import connected_users
+# Shared with direct chat: verified tokens are cached there until shortly before they expire
+from app.realtime.chat import validate_token
 import datetime
+from datetime import timezone
 import logging
 import os
-import json
 
 DEBUG_MODE = os.environ.get('FLASK_ENV') == 'development'
 
-logging.basicConfig(level=logging.DEBUG if DEBUG_MODE else logging.INFO)
 logger = logging.getLogger(__name__)
 
-def validate_token(token):
-    """Validate JWT token and return the decoded token or None if invalid"""
-    if not token:
-        return None
-    try:
-        decoded_token = decode_token(token)
-        return decoded_token
-    except Exception:  
-        return None
+# Per-user work for big groups is done this many members at a time, yielding to other sockets in between
+BROADCAST_BATCH = 50
+
+def emit_in_batches(event, payload, rooms):
+    """Emit to many rooms; lists longer than BROADCAST_BATCH are sent in slices with a yield between"""
+    for start in range(0, len(rooms), BROADCAST_BATCH):
+        if start:
+            socketio.sleep(0)
+        socketio.emit(event, payload, to=rooms[start:start + BROADCAST_BATCH])
+
+def emit_to_group(event, payload, group, skip_sid=None):
+    """Send an event to every member of a group, in one broadcast to the member room
+    
+    Members join the room on their own worker when they connect; with a message queue
+    every worker then delivers the event to the members connected to it.
+    """
+    socketio.emit(event, payload, to=group_room(group['_id']), skip_sid=skip_sid)
+
+def join_group_room(group, user_ids):
+    """Add the sessions on this worker of the given users to a group's member room
+    
+    Only users the group document lists as members are joined, whatever ids the client sent.
+    Members connected to another worker join when their client sends join_group.
+    """
+    room = group_room(group['_id'])
+    member_ids = group['_member_ids']
+    for i, user_id in enumerate(user_ids, 1):
+        user_id = str(user_id)
+        sid = connected_users.get(user_id) if user_id in member_ids else None
+        if sid:
+            join_rooms([room], sid=sid, namespace='/')
+        if i % BROADCAST_BATCH == 0:
+            socketio.sleep(0)
+
+def authorized_group(data, admin_only=False):
+    """Validate the event's token and load its group fresh from the database
+    
+    Returns (user_id, group), or (None, None) after emitting an error when the token is
+    invalid, the group doesn't exist, or the user isn't a member (an admin with admin_only).
+    """
+    decoded_token = validate_token(data.get('token'))
+    if not decoded_token:
+        emit('error', {'message': 'Invalid or missing token'})
+        return None, None
+    user_id = decoded_token['sub']
+    
+    group_id = data.get('group_id')
+    if not group_id:
+        emit('error', {'message': 'Missing group_id'})
+        return None, None
+    
+    # The change may have been saved by another worker; don't trust this one's cached copy
+    Group.forget_cached(group_id)
+    group = Group.get_cached(group_id)
+    if not group:
+        emit('error', {'message': 'Group not found'})
+        return None, None
+    
+    allowed = {str(admin_id) for admin_id in group.get('admins', [])} if admin_only else group['_member_ids']
+    if user_id not in allowed:
+        logger.warning("User %s may not send events for group %s", user_id, group_id)
+        emit('error', {'message': 'Not allowed for this group'})
+        return None, None
+    return user_id, group
+
+def leave_group_room(user_id, group_id):
+    """Take a user's session on this worker out of a group's member room
+    
+    Members connected to another worker leave it when their client sends leave_group.
+    """
+    sid = connected_users.get(str(user_id))
+    if sid:
+        socketio.server.leave_room(sid, group_room(group_id), namespace='/')
 
 def register_handlers(socketio):
     """Register all Socket.IO event handlers for group chat"""
@@ -32,16 +98,6 @@ def register_handlers(socketio):
     def handle_group_created(data):
         """Handle group creation notification"""
         try:
-            # Get the JWT token from the auth header or connection
-            token = data.get('token')
-            if not token:
-                emit('error', {'message': 'Authentication required'})
-                return
-            
-            # Decode token to get user info
-            decoded_token = decode_token(token)
-            current_user_id = decoded_token['sub']
-            
             group_id = data.get('group_id')
             group_name = data.get('group_name')
             member_ids = data.get('member_ids', [])
@@ -50,24 +106,36 @@ def register_handlers(socketio):
                 emit('error', {'message': 'Missing required group data'})
                 return
             
+            # The creator must be in the saved group; its member list, not the client's, is used below
+            current_user_id, group = authorized_group(data)
+            if not group:
+                return
+            
+            # One timestamp for every notification this event sends
+            timestamp = datetime.datetime.now(timezone.utc).isoformat()
+            
             # Get creator info
             creator = User.get_by_id(current_user_id)
             creator_name = creator.get('username', 'Unknown User') if creator else 'Unknown User'
             
-            # Notify each member (except creator) that they've been added to a group
-            for member_id in member_ids:
-                if str(member_id) != str(current_user_id):
-                    socketio.emit('group_added', {
-                        'group_id': group_id,
-                        'group_name': group_name,
-                        'creator_name': creator_name,
-                        'timestamp': datetime.datetime.now(timezone.utc).isoformat()
-                    }, room=f'user_{member_id}')
+            # Members (and the creator) receive later group broadcasts through the member room
+            join_group_room(group, group['_member_ids'])
             
-            print(f"Group creation notifications sent for group {group_id}")
+            # Notify each member (except creator) that they've been added to a group,
+            # one emit per batch of their user rooms
+            member_rooms = [f'user_{member_id}' for member_id in group['_member_ids']
+                            if member_id != current_user_id]
+            emit_in_batches('group_added', {
+                'group_id': group_id,
+                'group_name': group_name,
+                'creator_name': creator_name,
+                'timestamp': timestamp
+            }, member_rooms)
+            
+            logger.info("Group creation notifications sent for group %s", group_id)
             
         except Exception as e:
-            print(f"Error handling group creation: {str(e)}")
+            logger.error("Error handling group creation: %s", e)
             emit('error', {'message': 'Failed to process group creation'})
 
     @socketio.on('member_added_to_group')
@@ -83,34 +151,44 @@ def register_handlers(socketio):
                 emit('error', {'message': 'Missing required data for member addition'})
                 return
             
+            # Only a group admin announces additions, and only of users the group now lists
+            _, group = authorized_group(data, admin_only=True)
+            if not group:
+                return
+            if str(member_id) not in group['_member_ids']:
+                emit('error', {'message': 'User is not a member of this group'})
+                return
+            
+            timestamp = datetime.datetime.now(timezone.utc).isoformat()
+            
             # Notify the added member
             socketio.emit('member_added_to_group', {
                 'group_id': group_id,
                 'group_name': group_name,
                 'admin_name': admin_name,
-                'timestamp': datetime.datetime.now(timezone.utc).isoformat()
+                'timestamp': timestamp
             }, room=f'user_{member_id}')
             
-            # Notify all other group members about the new member
-            group = Group.get_by_id(group_id)
-            if group:
-                added_user = User.get_by_id(member_id)
-                added_username = added_user.get('username', 'Unknown User') if added_user else 'Unknown User'
-                
-                for existing_member_id in group['members']:
-                    if str(existing_member_id) != str(member_id):  # Don't notify the added member again
-                        socketio.emit('group_member_added', {
-                            'group_id': group_id,
-                            'group_name': group_name,
-                            'added_member_name': added_username,
-                            'admin_name': admin_name,
-                            'timestamp': datetime.datetime.now(timezone.utc).isoformat()
-                        }, room=f'user_{existing_member_id}')
-            
-            print(f"Member addition notifications sent for group {group_id}")
+            # Notify all other group members about the new member, in one room broadcast
+            # sent before the added member joins the room so they aren't notified again.
+            # If they are on another worker they join it there, on their next join_group
+            added_user = User.get_by_id(member_id)
+            added_username = added_user.get('username', 'Unknown User') if added_user else 'Unknown User'
+            
+            emit_to_group('group_member_added', {
+                'group_id': group_id,
+                'group_name': group_name,
+                'added_member_name': added_username,
+                'admin_name': admin_name,
+                'timestamp': timestamp
+            }, group)
+            
+            join_group_room(group, [member_id])
+            
+            logger.info("Member addition notifications sent for group %s", group_id)
             
         except Exception as e:
-            print(f"Error handling member addition: {str(e)}")
+            logger.error("Error handling member addition: %s", e)
             emit('error', {'message': 'Failed to process member addition'})
 
     @socketio.on('member_removed_from_group')
@@ -128,32 +206,52 @@ def register_handlers(socketio):
                 emit('error', {'message': 'Missing required data for member removal'})
                 return
             
+            decoded_token = validate_token(data.get('token'))
+            if not decoded_token:
+                emit('error', {'message': 'Invalid or missing token'})
+                return
+            current_user_id = decoded_token['sub']
+            removed_member_id = str(removed_member_id)
+            
+            # Only an admin or the leaving member announces a removal, and only once it is saved
+            Group.forget_cached(group_id)
+            group = Group.get_cached(group_id)
+            if not group:
+                emit('error', {'message': 'Group not found'})
+                return
+            is_admin = current_user_id in {str(admin_id) for admin_id in group.get('admins', [])}
+            if not (is_admin or current_user_id == removed_member_id) or removed_member_id in group['_member_ids']:
+                emit('error', {'message': 'Not allowed for this group'})
+                return
+            
+            timestamp = datetime.datetime.now(timezone.utc).isoformat()
+            
             # Notify the removed member
             socketio.emit('member_removed_from_group', {
                 'group_id': group_id,
                 'group_name': group_name,
                 'admin_name': admin_name,
                 'removed_by_self': removed_by_self,
-                'timestamp': datetime.datetime.now(timezone.utc).isoformat()
+                'timestamp': timestamp
             }, room=f'user_{removed_member_id}')
             
-            # Notify remaining group members about the removal
-            group = Group.get_by_id(group_id)
-            if group:
-                for remaining_member_id in group['members']:
-                    socketio.emit('group_member_removed', {
-                        'group_id': group_id,
-                        'group_name': group_name,
-                        'removed_member_name': removed_member_name,
-                        'admin_name': admin_name,
-                        'removed_by_self': removed_by_self,
-                        'timestamp': datetime.datetime.now(timezone.utc).isoformat()
-                    }, room=f'user_{remaining_member_id}')
-            
-            print(f"Member removal notifications sent for group {group_id}")
+            # The removed member stops receiving group broadcasts
+            leave_group_room(removed_member_id, group_id)
+            
+            # Notify remaining group members about the removal, in one room broadcast
+            emit_to_group('group_member_removed', {
+                'group_id': group_id,
+                'group_name': group_name,
+                'removed_member_name': removed_member_name,
+                'admin_name': admin_name,
+                'removed_by_self': removed_by_self,
+                'timestamp': timestamp
+            }, group)
+            
+            logger.info("Member removal notifications sent for group %s", group_id)
             
         except Exception as e:
-            print(f"Error handling member removal: {str(e)}")
+            logger.error("Error handling member removal: %s", e)
             emit('error', {'message': 'Failed to process member removal'})
 
     @socketio.on('group_name_updated')
@@ -169,22 +267,24 @@ def register_handlers(socketio):
                 emit('error', {'message': 'Missing required data for group name update'})
                 return
             
-            # Notify all group members about the name change
-            group = Group.get_by_id(group_id)
+            timestamp = datetime.datetime.now(timezone.utc).isoformat()
+            
+            # Notify all group members about the name change, in one room broadcast
+            Group.forget_cached(group_id)
+            group = Group.get_cached(group_id)
             if group:
-                for member_id in group['members']:
-                    socketio.emit('group_name_updated', {
-                        'group_id': group_id,
-                        'old_name': old_name,
-                        'new_name': new_name,
-                        'admin_name': admin_name,
-                        'timestamp': datetime.datetime.now(timezone.utc).isoformat()
-                    }, room=f'user_{member_id}')
+                emit_to_group('group_name_updated', {
+                    'group_id': group_id,
+                    'old_name': old_name,
+                    'new_name': new_name,
+                    'admin_name': admin_name,
+                    'timestamp': timestamp
+                }, group)
             
-            print(f"Group name update notifications sent for group {group_id}")
+            logger.info("Group name update notifications sent for group %s", group_id)
             
         except Exception as e:
-            print(f"Error handling group name update: {str(e)}")
+            logger.error("Error handling group name update: %s", e)
             emit('error', {'message': 'Failed to process group name update'})
 
     @socketio.on('join_group')
@@ -194,9 +294,17 @@ def register_handlers(socketio):
             group_id = data.get('group_id')
             if group_id:
                 join_room(f'group_{group_id}')
-                print(f"User joined group room: group_{group_id}")
+                logger.debug("User joined group room: group_%s", group_id)
+                
+                # Members added while connected to another worker join the member room here
+                # (read fresh: the addition was saved moments ago, maybe by another worker)
+                user_id = sid_to_user.get(request.sid)
+                Group.forget_cached(group_id)
+                group = Group.get_cached(group_id)
+                if user_id and group and user_id in group['_member_ids']:
+                    join_rooms([group_room(group_id)])
         except Exception as e:
-            print(f"Error joining group room: {str(e)}")
+            logger.error("Error joining group room: %s", e)
     
     @socketio.on('leave_group')
     def handle_leave_group(data):
@@ -205,116 +313,58 @@ def register_handlers(socketio):
             group_id = data.get('group_id')
             if group_id:
                 leave_room(f'group_{group_id}')
-                print(f"User left group room: group_{group_id}")
+                logger.debug("User left group room: group_%s", group_id)
+                
+                # Members removed while connected to another worker leave the member room here
+                user_id = sid_to_user.get(request.sid)
+                Group.forget_cached(group_id)
+                group = Group.get_cached(group_id)
+                if user_id and (not group or user_id not in group['_member_ids']):
+                    leave_group_room(user_id, group_id)
         except Exception as e:
-            print(f"Error leaving group room: {str(e)}")
+            logger.error("Error leaving group room: %s", e)
 
     @socketio.on('send_group_message')
     def handle_send_group_message(data):
         """Handle sending a message to a group."""
-        print("\n========== WEBSOCKET: NEW GROUP MESSAGE RECEIVED ==========")
-        print(f"Raw group message data from client: {data}") 
+        logger.debug("send_group_message data=%r", data)
         
         client_attachment_payload = data.get('attachment')
-        if client_attachment_payload:
-            print(f"Client attachment payload received: {client_attachment_payload}")
-            print(f"Keys in client_attachment_payload: {list(client_attachment_payload.keys()) if isinstance(client_attachment_payload, dict) else 'Not a dict'}")
 
         token = data.get('token')
         decoded_token = validate_token(token)
         if not decoded_token:
-            print("ERROR: Invalid or missing token")
+            logger.warning("send_group_message rejected: invalid or missing token")
             emit('error', {'message': 'Invalid or missing token'})
             return
 
-        print(f"Token validated for user: {decoded_token['sub']}")
-
         sender_id = decoded_token['sub']
         group_id = data.get('group_id')
         content = data.get('content', '')
         message_type = data.get('message_type', 'text')
         
         # Validate group exists and user is a member
-        group = Group.get_by_id(group_id)
+        group = Group.get_cached(group_id)
         if not group:
-            print(f"ERROR: Group {group_id} not found")
+            logger.warning("Group %s not found", group_id)
             emit('error', {'message': 'Group not found'})
             return
         
-        from bson import ObjectId
-        if ObjectId(sender_id) not in group['members']:
-            print(f"ERROR: User {sender_id} is not a member of group {group_id}")
+        if sender_id not in group['_member_ids']:
+            logger.warning("User %s is not a member of group %s", sender_id, group_id)
             emit('error', {'message': 'You are not a member of this group'})
             return
         
-        print(f"Group message room: group_{group_id}")
-        
-        attachment_to_save = None # Renamed from 'attachment' to avoid confusion
-        
+        # Same resolution as direct chat: one aggregation over media and files by id, then filename
+        attachment_to_save = None
         if client_attachment_payload and isinstance(client_attachment_payload, dict):
-           
-            media_doc_id = client_attachment_payload.get('fileId') 
-            
-        
-            if not media_doc_id:
-                media_doc_id = client_attachment_payload.get('file_id')
-
-            original_filename = client_attachment_payload.get('filename')
-            
-            resolved_file_type = client_attachment_payload.get('type') or client_attachment_payload.get('file_type') or 'document' 
-
-            print(f"Processing client attachment: media_doc_id='{media_doc_id}', filename='{original_filename}', type='{resolved_file_type}'")
-
-            file_info = None
-            if media_doc_id and media_doc_id not in ['undefined', 'null', None, '']:
-                print(f"Attempting to fetch Media/File object using ID: {media_doc_id} (type hint: {resolved_file_type})")
-                from app.models.media import Media
-                from app.models.file import File
-                if resolved_file_type in ('image', 'video', 'audio'):
-                    file_info = Media.get_by_id(media_doc_id)
-                else:
-                    file_info = File.get_by_id(media_doc_id)
-                
-                if file_info:
-                    print(f"Successfully fetched by ID: {file_info['_id']}")
-                else:
-                    # If ID lookup fails, maybe it was a filename passed as fileId by mistake, or bad ID
-                    print(f"WARN: Could not find Media/File for ID: {media_doc_id}. Will try filename lookup if available.")
-            
-            # If file_info not found by ID, AND we have an original_filename, try by filename
-            if not file_info and original_filename:
-                print(f"Attempting to fetch by filename: '{original_filename}' for user '{sender_id}' (type hint: {resolved_file_type})")
-                if resolved_file_type in ('image', 'video', 'audio'):
-                    file_info = Media.get_most_recent_by_user_and_filename(sender_id, original_filename)
-                else:
-                    file_info = File.get_most_recent_by_user_and_filename(sender_id, original_filename)
-                
-                if file_info:
-                    print(f"Successfully fetched by filename: {file_info['_id']}")
-                else:
-                    print(f"WARN: Could not find Media/File by filename: {original_filename}")
-
-            if file_info:
-                # Determine the most reliable message_type from the retrieved file_info
-                message_type = file_info.get('media_type') or file_info.get('file_type') or resolved_file_type
-                attachment_to_save = {
-                    "file_id": str(file_info['_id']),
-                    "file_type": message_type,
-                    "filename": file_info.get('original_filename', original_filename or ''),
-                    "mime_type": file_info.get('mime_type', ''),
-                    "size": file_info.get('file_size', 0)
-                }
-            else:
-                print(f"ERROR: Attachment processing failed. No file_info found for: {client_attachment_payload}")
-                # Keep original message_type if attachment fails, or reset if it was file-specific
-                if message_type not in ['text'] and not content: # If it was e.g. 'video' but no content and attach failed
-                    message_type = 'text' # Default to text if attachment fails and no content
+            attachment_to_save, message_type = resolve_attachment(
+                client_attachment_payload, sender_id, message_type, content
+            )
         
-        print(f"Final attachment to save in DB: {attachment_to_save}")
-        print(f"Final message_type for DB: {message_type}")
+        logger.debug("attachment=%r message_type=%s", attachment_to_save, message_type)
 
         try:
-            print(f"Creating group message in database...")
             message = GroupMessage.create(
                 group_id=group_id,
                 sender_id=sender_id,
@@ -322,50 +372,52 @@ def register_handlers(socketio):
                 message_type=message_type,
                 attachment=attachment_to_save # Use the processed attachment_to_save
             )
-            print(f"Group message created successfully with ID: {message['_id']}")
+            logger.debug("group message %s saved", message['_id'])
         except Exception as e:
-            print(f"ERROR: Failed to save group message to database - {str(e)}")
+            logger.error("Failed to save group message: %s", e)
             emit('error', {'message': 'Failed to save group message'})
             return
+        
+        # Formatted once, shared by the broadcast and the ack
+        message_id_str = str(message['_id'])
+        timestamp = message['created_at'].isoformat()
+        
+        # Acknowledgment to the sender
+        ack_payload = {
+            'status': 'success',
+            'message_id': message_id_str,
+            'timestamp': timestamp
+        }
+        
+        # No other member online: the message is saved, members read it from history
+        if not room_has_listeners(group_room(group_id), request.sid):
+            return ack_payload
 
         try:
-            # Fetch sender details from User model
-            sender = User.get_by_id(sender_id)
+            # Sender name/avatar, cached in the User model across messages
+            sender_name, sender_avatar = User.get_sender_profile(sender_id)
             
-            # Convert ObjectId and datetime objects to strings
+            # ObjectIds go in as-is: the packet serializer encodes them (see init_socketio)
             message_payload = {
-                'id': str(message['_id']),
-                'group_id': str(message['group_id']),
-                'sender': str(message['sender_id']),
-                'sender_name': sender.get('username', ''),  # Use username as sender_name
-                'sender_avatar': sender.get('profile_picture', ''),  # Use profile_picture as sender_avatar
+                'id': message_id_str,
+                'group_id': message['group_id'],
+                'sender': message['sender_id'],
+                'sender_name': sender_name,
+                'sender_avatar': sender_avatar,
                 'content': message['content'],
-                'timestamp': message['created_at'].isoformat(),
+                'timestamp': timestamp,
                 'message_type': message['message_type'],
                 'attachment': message['attachment'],
-                'read_by': [str(user_id) for user_id in message.get('read_by', [])]
+                'read_by': message.get('read_by', [])
             }
             
-            # Broadcast to all group members except the sender to avoid duplicates
-            print(f"Broadcasting group message to group members (excluding sender {sender_id})")
-            for member_id in group['members']:
-                member_id_str = str(member_id)
-                if member_id_str != sender_id:  # Exclude the sender
-                    emit('receive_group_message', message_payload, room=f'user_{member_id_str}')
-                    print(f"Sent group message to member: {member_id_str}")
+            # Broadcast to all group members except the sending socket to avoid duplicates;
+            # the sender's other sessions still receive it
+            emit_to_group('receive_group_message', message_payload, group, skip_sid=request.sid)
             
-            print(f"Group message broadcast successful (excluded sender)")
         except Exception as e:
-            print(f"ERROR: Failed to broadcast group message - {str(e)}")
+            logger.error("Failed to broadcast group message to group %s: %s", group_id, e)
             # Optionally notify sender of emission failure
             pass
         
-        # Return acknowledgment to the sender
-        ack_payload = {
-            'status': 'success',
-            'message_id': str(message['_id']),
-            'timestamp': message['created_at'].isoformat()
-        }
-        print(f"Sending acknowledgment to sender: {ack_payload}")
-        print("========== GROUP MESSAGE PROCESSING COMPLETE ==========\n")
         return ack_payload 
\ No newline at end of file
@@ -1,7 +1,6 @@
-from flask_socketio import emit
-from flask_jwt_extended import get_jwt_identity
 from app.models.presence import Presence
-from app.realtime.events import connected_users
+from app.models.user import User
+from app.realtime.events import notify_contacts_presence
 import datetime
 
 def register_handlers(socketio):
@@ -32,22 +31,8 @@ def register_handlers(socketio):
         Presence.update_status(current_user, status)
         
         # Notify user's contacts about status change
-        from app.utils.db import get_db
-        db = get_db()
-        
-        contacts = db.contacts.find({'contact_id': current_user, 'status': 'accepted'})
-        
-        # Get user details
-        user = db.users.find_one({'_id': current_user}, {'username': 1})
-        
-        for contact in contacts:
-            contact_id = str(contact['user_id'])
-            if contact_id in connected_users:
-                emit('presence_update', {
-                    'user_id': str(current_user),
-                    'username': user['username'],
-                    'status': status
-                }, room=f"user_{contact_id}")
+        username, _ = User.get_sender_profile(current_user)
+        notify_contacts_presence(current_user, username, status)
         
         return {'success': True}
 
@@ -70,13 +55,9 @@ def register_handlers(socketio):
             
         current_user = decoded_token['sub']
         
-        # Get contacts with their status
+        # Get contacts with their status (ObjectIds are encoded by the packet serializer)
         contacts_status = Presence.get_contacts_status(current_user)
         
-        # Convert ObjectId to string in the response
-        for contact in contacts_status:
-            contact['user_id'] = str(contact['user_id'])
-        
         return {'contacts': contacts_status}
 
     @socketio.on('get_users_status')
@@ -116,6 +97,7 @@ def register_handlers(socketio):
         
         # Create a lookup dictionary for presence data
         presence_by_id = {str(p["user_id"]): p for p in presence_list}
+        online_ids = Presence.online_user_ids(user_ids)
         
         # Combine the data
         result = []
@@ -125,23 +107,21 @@ def register_handlers(socketio):
             
             # Check if online status is stale (more than 10 minutes old)
             status = presence_data.get("status", Presence.STATUS_OFFLINE)
-            if status == Presence.STATUS_ONLINE:
+            if online_ids is not None:
+                status = Presence.STATUS_ONLINE if user_id_str in online_ids else Presence.STATUS_OFFLINE
+            elif status == Presence.STATUS_ONLINE:
                 if "last_updated" in presence_data:
-                    time_diff = datetime.datetime.now(timezone.utc) - presence_data["last_updated"]
+                    time_diff = datetime.datetime.utcnow() - presence_data["last_updated"]
                     if time_diff.total_seconds() > 600:  # 10 minutes instead of 2
                         status = Presence.STATUS_OFFLINE
             
-            # Convert datetime objects to ISO format strings
-            last_active = presence_data.get("last_active")
-            if last_active:
-                last_active = last_active.isoformat()
-            
+            # ObjectIds and datetimes are encoded by the packet serializer
             result.append({
-                "user_id": str(user["_id"]),
+                "user_id": user["_id"],
                 "username": user["username"],
                 "profile_picture": user.get("profile_picture"),
                 "status": status,
-                "last_active": last_active
+                "last_active": presence_data.get("last_active")
             })
         
         return {'users': result}
@@ -1,6 +1,6 @@
 from flask_socketio import emit
 from flask import request
-from app.realtime.events import connected_users
+from app.realtime.events import connected_users, queue_coalesced_emit
 
 def register_handlers(socketio):
     """Register all Socket.IO event handlers for typing indicators"""
@@ -28,7 +28,7 @@ def register_handlers(socketio):
         # Check if recipient is connected
         if recipient_id in connected_users:
             # Emit typing event to recipient
-            emit('typing_indicator', {
+            queue_coalesced_emit('typing_indicator', {
                 'user_id': str(current_user),
                 'status': 'typing'
             }, room=f"user_{recipient_id}")
@@ -56,7 +56,7 @@ def register_handlers(socketio):
         # Check if recipient is connected
         if recipient_id in connected_users:
             # Emit typing stopped event to recipient
-            emit('typing_indicator', {
+            queue_coalesced_emit('typing_indicator', {
                 'user_id': str(current_user),
                 'status': 'stopped'
             }, room=f"user_{recipient_id}")
@@ -83,7 +83,7 @@ def register_handlers(socketio):
             return
         
         # Emit to the group room
-        emit('group_typing_indicator', {
+        queue_coalesced_emit('group_typing_indicator', {
             'user_id': str(current_user),
             'group_id': group_id,
             'status': 'typing'
@@ -110,7 +110,7 @@ def register_handlers(socketio):
             return
         
         # Emit to the group room
-        emit('group_typing_indicator', {
+        queue_coalesced_emit('group_typing_indicator', {
             'user_id': str(current_user),
             'group_id': group_id,
             'status': 'stopped'
@@ -1,5 +1,5 @@
 from app import mongo
-from pymongo import IndexModel, ASCENDING, DESCENDING, TEXT
+from pymongo import IndexModel, UpdateOne, ASCENDING, DESCENDING, TEXT
 
 def get_db():
     """Helper function to get the database instance."""
@@ -41,6 +41,15 @@ def init_db(app):
             ])
         ])
         
+        # Covers the leading $match + $group of the user activity view
+        db.messages.create_indexes([
+            IndexModel([
+                ("is_deleted", ASCENDING),
+                ("sender_id", ASCENDING),
+                ("created_at", DESCENDING)
+            ])
+        ])
+        
         # Create indexes for groups collection
         db.groups.create_indexes([
             IndexModel([("name", TEXT)]),
@@ -60,7 +69,21 @@ def init_db(app):
             IndexModel([("uploader_id", ASCENDING)]),
             IndexModel([("message_id", ASCENDING)]),
             IndexModel([("created_at", DESCENDING)]),
-            IndexModel([("file_type", ASCENDING)])
+            IndexModel([("file_type", ASCENDING)]),
+            # Filename lookups for chat attachments (File.resolve_attachment)
+            IndexModel([
+                ("uploader_id", ASCENDING),
+                ("original_filename", ASCENDING),
+                ("created_at", DESCENDING)
+            ])
+        ])
+        
+        db.media.create_indexes([
+            IndexModel([
+                ("uploader_id", ASCENDING),
+                ("original_filename", ASCENDING),
+                ("created_at", DESCENDING)
+            ])
         ])
         
         # Create indexes for message_reactions collection
@@ -73,7 +96,9 @@ def init_db(app):
         db.contacts.create_indexes([
             IndexModel([("user_id", ASCENDING)]),
             IndexModel([("contact_id", ASCENDING)]),
-            IndexModel([("status", ASCENDING)])
+            IndexModel([("status", ASCENDING)]),
+            # A user's accepted contacts (presence rooms joined on connect, contacts status)
+            IndexModel([("user_id", ASCENDING), ("status", ASCENDING), ("contact_id", ASCENDING)])
         ])
         
         # Create indexes for presence collection
@@ -124,17 +149,30 @@ def init_db(app):
             IndexModel([("is_valid", ASCENDING)])
         ])
         
+        # One outstanding reset token per user; generate_reset_token upserts on user_id
+        db.password_reset_tokens.create_indexes([
+            IndexModel([("user_id", ASCENDING)], unique=True),
+            IndexModel([("token", ASCENDING)])
+        ])
+        
         db.notifications.create_indexes([
             IndexModel([("user_id", ASCENDING)]),
             IndexModel([("is_read", ASCENDING)]),
             IndexModel([("created_at", DESCENDING)])
         ])
         
+        # Expire stale analytics refresh locks left behind by crashed workers
+        db.refresh_locks.create_index([("expires_at", ASCENDING)], expireAfterSeconds=0)
+        
         print("Database indexes created successfully")
         
         # Add version field to existing groups for optimistic locking
         update_groups_for_concurrency_control(db)
         
+        # Backfill denormalized fields read by the analytics views
+        backfill_message_usernames(db)
+        backfill_group_message_counters(db)
+        
         # Create database views for analytics
         create_analytics_views(db)
 
@@ -155,6 +193,67 @@ def update_groups_for_concurrency_control(db):
     except Exception as e:
         print(f"Error updating groups for concurrency control: {e}")
 
+def backfill_message_usernames(db):
+    """Copy participant names onto messages stored before they were denormalized on write."""
+    try:
+        if not db.messages.count_documents({"sender_username": {"$exists": False}}, limit=1):
+            print("All messages already have denormalized usernames")
+            return
+        
+        db.messages.aggregate([
+            {"$match": {"sender_username": {"$exists": False}}},
+            {"$lookup": {"from": "users", "localField": "sender_id", "foreignField": "_id", "as": "sender"}},
+            {"$lookup": {"from": "users", "localField": "recipient_id", "foreignField": "_id", "as": "recipient"}},
+            {"$project": {
+                "sender_username": {"$arrayElemAt": ["$sender.username", 0]},
+                "sender_email": {"$arrayElemAt": ["$sender.email", 0]},
+                "recipient_username": {"$arrayElemAt": ["$recipient.username", 0]}
+            }},
+            {"$merge": {"into": "messages", "on": "_id", "whenMatched": "merge", "whenNotMatched": "discard"}}
+        ], allowDiskUse=True)
+        
+        print("Backfilled denormalized usernames on existing messages")
+        
+    except Exception as e:
+        print(f"Error backfilling message usernames: {e}")
+
+def backfill_group_message_counters(db):
+    """Populate message counters on groups created before they were maintained on write."""
+    try:
+        group_ids = [g["_id"] for g in db.groups.find({"total_messages": {"$exists": False}}, {"_id": 1})]
+        
+        if not group_ids:
+            print("All groups already have message counters")
+            return
+        
+        counters = db.group_messages.aggregate([
+            {"$match": {"group_id": {"$in": group_ids}, "is_deleted": False}},
+            {"$group": {
+                "_id": "$group_id",
+                "total_messages": {"$sum": 1},
+                "last_message_time": {"$max": "$created_at"},
+                "first_message_time": {"$min": "$created_at"}
+            }}
+        ])
+        
+        operations = [
+            UpdateOne({"_id": counter.pop("_id")}, {"$set": counter})
+            for counter in counters
+        ]
+        if operations:
+            db.groups.bulk_write(operations, ordered=False)
+        
+        # Groups without any messages start at zero
+        db.groups.update_many(
+            {"_id": {"$in": group_ids}, "total_messages": {"$exists": False}},
+            {"$set": {"total_messages": 0}}
+        )
+        
+        print(f"Added message counters to {len(group_ids)} existing groups")
+        
+    except Exception as e:
+        print(f"Error backfilling group message counters: {e}")
+
 def create_analytics_views(db):
     """Create database views for enhanced analytics."""
     try:
@@ -1,3 +1,7 @@
+# Patch blocking I/O before anything else (including pymongo) is imported
+import eventlet
+eventlet.monkey_patch()
+
 from app import create_app
 from app.utils.db import init_db
 import os
@@ -11,15 +15,8 @@ if __name__ == "__main__":
     print(f"Starting server with SocketIO on port {port}")
 
     
-    # Get the SocketIO instance from our app
-    # It's already set up in create_app, just need to import it
-    from flask_socketio import SocketIO
-    socketio = app.extensions.get('socketio')
-    
-    if not socketio:
-        print("ERROR: SocketIO not properly initialized!")
-        # Create a new instance if needed as fallback
-        socketio = SocketIO(app)
+    # The SocketIO instance is bound to the app in create_app
+    from app.realtime import socketio
     
     # Run the SocketIO server
     socketio.run(app, host="0.0.0.0", port=port, debug=True)
\ No newline at end of file